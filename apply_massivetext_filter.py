@@ -1,159 +1,446 @@
 import json
 from tqdm import tqdm
-import io
+from collections import Counter
 from multiprocessing import Pool
 import os
-import gzip
-import jieba
-# from flagged_words import flagged_words
-# badwords = flagged_words["zh"]
+import time
+import numpy as np
+from flagged_words_matcher import is_bad_doc, normalize_lang
+from utils import Writer, add_codec_args, clear_done, exit_on_sigterm, is_data_file, map_windows, mark_done, next_index, open_file, read_manifest, strip_extension, watch_shards
 
 num_workers = 30
 
-def is_bad_doc(doc, badwords):
-    count = 0
-    for bad_word in badwords:
-        bad_word = bad_word.strip()
-        if bad_word in doc:
-            count += doc.count(bad_word)
-            if count > 3:
-                return True
-
-    return False
-
 def load_file(dataset_name):
-    with gzip.open(dataset_name, 'rb') as fp:
+    with open_file(dataset_name, 'rb') as fp:
         for line in fp:
             yield line
             
-def count_ngrams(text, ngrams_dict):
-    for i in range(len(text)):
-        for n in range(2, 5):
-            gram = tuple(text[i:i+n])
-            if len(gram) == n:
-                if gram in ngrams_dict[n]:
-                    ngrams_dict[n][gram] += 1
-                else:
-                    ngrams_dict[n][gram] = 1
-    return ngrams_dict
-
-def process(item):
-    text = item.get('content', '')
-    
-    # 删除字数量不在100~100000范围内的文档
-    # if text is None:
-    #     import pdb; pdb.set_trace()
-    if len(text) < 100 or len(text) > 100000:
-        return False
-    
-    # 对于行和段落，计算重复行和段落所占比例以及重复行和重复段落字符所占比例，并删除重复比大于30%的文档
-    counter = {}
-    n_lines = 0
-    n_chars = 0
-    for line in text.split('\n'):
-        line = line.strip()
-        if line:
-            if line in counter:
-                counter[line] += 1
-            else:
-                counter[line] = 1
-            n_lines += 1
-            n_chars += len(line)
-    n_dup_lines = 0
-    n_dup_chars = 0
-    for line, n in counter.items():
+# for ngram 2-4
+top_ngram_character_fractions = [
+    (2, 0.2),
+    (3, 0.18),
+    (4, 0.16),
+]
+# for ngram 5-10
+duplicate_ngram_character_fractions = [
+    (5, 0.15),
+    (6, 0.14),
+    (7, 0.13),
+    (8, 0.12),
+    (9, 0.11),
+    (10, 0.10),
+]
+_HASH_BASE = np.uint64(0x100000001B3)
+
+def encode_words(word_list):
+    "map every word to an integer id, also return the word lengths"
+    vocab = {}
+    ids = np.fromiter((vocab.setdefault(w, len(vocab)) for w in word_list), dtype=np.uint64, count=len(word_list))
+    lens = np.fromiter((len(w) for w in word_list), dtype=np.int64, count=len(word_list))
+    return ids, lens
+
+def top_ngram_fraction(hashes, n, line_ids, char_sums, n_chars):
+    "characters of the most frequent n-gram (within a line) times its count, over all characters"
+    # 和逐行统计一样，不统计跨行的 ngram
+    positions = np.nonzero(line_ids[:len(hashes)] == line_ids[n - 1:])[0]
+    if len(positions) == 0:
+        return 0.0
+    _, first_index, counts = np.unique(hashes[positions], return_index=True, return_counts=True)
+    max_repeat = counts.max()
+    # 次数相同时取最先出现的 ngram
+    first = first_index[counts == max_repeat].min()
+    return char_sums[positions[first]] * max_repeat / n_chars
+
+def duplicate_ngram_fraction(hashes, n, lens, n_chars):
+    "characters covered by the repeated occurrences of n-grams, over all characters"
+    _, first_index, inverse = np.unique(hashes, return_index=True, return_inverse=True)
+    starts = np.nonzero(first_index[inverse] != np.arange(len(hashes)))[0]
+    if len(starts) == 0:
+        return 0.0
+    # 差分数组标记被重复 ngram 覆盖的词
+    diff = np.bincount(starts, minlength=len(lens) + 1) - np.bincount(starts + n, minlength=len(lens) + 1)
+    covered = np.cumsum(diff[:len(lens)]) > 0
+    return lens[covered].sum() / n_chars
+
+_jieba = None
+
+def jieba_tokenize(line):
+    "jieba, the dictionary is only loaded by the first Chinese document of the process"
+    global _jieba
+    if _jieba is None:
+        import jieba
+        _jieba = jieba
+    return _jieba.lcut(line)
+
+def whitespace_tokenize(line):
+    return line.split()
+
+# 用空格分词的语言不需要 jieba
+TOKENIZERS = {
+    'zh': jieba_tokenize,
+}
+DEFAULT_TOKENIZER = whitespace_tokenize
+
+def get_tokenizer(languages):
+    "the tokenizer of the first language of the record that has one"
+    for lang in languages:
+        tokenizer = TOKENIZERS.get(normalize_lang(lang))
+        if tokenizer is not None:
+            return tokenizer
+    return DEFAULT_TOKENIZER
+
+class Document:
+    "a record under filtering, the views of its text are built on first use and shared by the rules"
+    def __init__(self, item):
+        self.item = item
+        self.text = item.get('content', '') or ''
+        # 没有语言字段的旧数据按中文处理; 旧版下载脚本用 langdetect 判断的页面存的是字符串
+        languages = item.get('languages') or ('zh',)
+        if isinstance(languages, str):
+            languages = (languages,)
+        self.languages = languages
+        self._stripped = None
+        self._lines = None
+        self._line_duplicates = None
+        self._paragraph_duplicates = None
+        self._words = None
+        self._hashes = None
+
+    @property
+    def stripped(self):
+        "every line of the text stripped, the text is split only once for all rules"
+        if self._stripped is None:
+            self._stripped = list(map(str.strip, self.text.split('\n')))
+        return self._stripped
+
+    @property
+    def lines(self):
+        "(line number, stripped line) of the non-empty lines"
+        if self._lines is None:
+            self._lines = [(line_no, line) for line_no, line in enumerate(self.stripped) if line]
+        return self._lines
+
+    @property
+    def line_duplicates(self):
+        "(fraction of duplicate lines, fraction of characters in them), None without lines"
+        if self._line_duplicates is None:
+            # str 会缓存自己的 hash, 以行本身为键不会复制
+            counts = {}
+            for line in self.stripped:
+                if line:
+                    counts[line] = counts.get(line, 0) + 1
+            self._line_duplicates = duplicate_fractions(counts, len)
+        return self._line_duplicates
+
+    @property
+    def paragraph_duplicates(self):
+        "(fraction of duplicate paragraphs, fraction of characters in them), None without paragraphs"
+        if self._paragraph_duplicates is None:
+            # 段落是连续的非空行, 用它的行组成的 tuple 计数, 不拼接段落字符串
+            counts = {}
+            stripped = self.stripped
+            start = None
+            for i, line in enumerate(stripped):
+                if line:
+                    if start is None:
+                        start = i
+                elif start is not None:
+                    key = tuple(stripped[start:i])
+                    counts[key] = counts.get(key, 0) + 1
+                    start = None
+            if start is not None:
+                key = tuple(stripped[start:])
+                counts[key] = counts.get(key, 0) + 1
+            self._paragraph_duplicates = duplicate_fractions(counts, paragraph_length)
+        return self._paragraph_duplicates
+
+    @property
+    def words(self):
+        "word ids, word lengths, line number of every word and the cumulative word lengths"
+        if self._words is None:
+            tokenize = get_tokenizer(self.languages)
+            word_list = []
+            line_ids = []
+            for line_no, line in self.lines:
+                words = tokenize(line)
+                word_list.extend(words)
+                line_ids.extend([line_no] * len(words))
+            ids, lens = encode_words(word_list)
+            self._words = ids, lens, np.asarray(line_ids), np.concatenate([[0], np.cumsum(lens)])
+        return self._words
+
+    @property
+    def word_ids(self):
+        return self.words[0]
+
+    @property
+    def word_lens(self):
+        return self.words[1]
+
+    @property
+    def word_line_ids(self):
+        return self.words[2]
+
+    def ngram_char_sums(self, n):
+        "number of characters of every word n-gram"
+        cumsum = self.words[3]
+        return cumsum[n:] - cumsum[:-n]
+
+    def ngram_hashes(self, n):
+        "rolling hashes of every word n-gram, lower orders are kept to roll the higher ones"
+        if self._hashes is None:
+            self._hashes = {1: self.word_ids}
+        for k in range(max(self._hashes) + 1, n + 1):
+            # hash(w_i..w_{i+k-1}) = hash(w_i..w_{i+k-2}) * B + id(w_{i+k-1}), 在 uint64 上溢出回绕
+            self._hashes[k] = self._hashes[k - 1][:-1] * _HASH_BASE + self.word_ids[k - 1:]
+        return self._hashes[n]
+
+class Rule:
+    "a filter rule, called on a Document and returns False to reject it"
+    name = None
+
+    def __call__(self, doc):
+        raise NotImplementedError
+
+class LengthRule(Rule):
+    "删除字数量不在100~100000范围内的文档"
+    name = 'length'
+
+    def __init__(self, min_chars=100, max_chars=100000):
+        self.min_chars = min_chars
+        self.max_chars = max_chars
+
+    def __call__(self, doc):
+        return self.min_chars <= len(doc.text) <= self.max_chars
+
+def paragraph_length(paragraph):
+    return sum(map(len, paragraph))
+
+def duplicate_fractions(counts, length):
+    """fraction of the blocks that occur more than once, and of the characters in them;
+    counts maps a block to its occurrences, length gives the characters of a block"""
+    if not counts:
+        return None
+    n_blocks = n_chars = n_dup_blocks = n_dup_chars = 0
+    for block, n in counts.items():
+        chars = length(block) * n
+        n_blocks += n
+        n_chars += chars
         if n > 1:
-            n_dup_lines += n 
-            n_dup_chars += len(line) * n
-    dup_line_ratio = n_dup_lines / n_lines
-    dup_char_ratio = n_dup_chars / n_chars
-    if dup_line_ratio > 0.3 or dup_char_ratio > 0.3:
-        return False
-    
-    # 统计重复的ngram，并删除超过阈值的文档
-    ngrams = {n: {} for n in range(2, 5)}
-    word_list = []
-    for line in text.split('\n'):
-        line = line.strip()
-        if line:
-            words = jieba.lcut(line)
-            word_list.extend(words)
-            ngrams = count_ngrams(words, ngrams)
-    
-    n_chars = sum(len(w) for w in word_list)
-    
-    # for ngram 2-4
-    top_ngram_character_fractions = [
-        (2, 0.2),
-        (3, 0.18),
-        (4, 0.16),
-    ]
-    for n, threshold in top_ngram_character_fractions:
-        max_repeat = 0
-        max_repeat_w = ''
-        for w, repeat in ngrams[n].items():
-            if repeat > max_repeat:
-                max_repeat = repeat
-                max_repeat_w = w
-        char_count = sum([len(w) for w in max_repeat_w])
-        if char_count * max_repeat / n_chars > threshold:
+            n_dup_blocks += n
+            n_dup_chars += chars
+    return n_dup_blocks / n_blocks, n_dup_chars / n_chars
+
+class DuplicateLineRule(Rule):
+    "删除重复行或重复行字符所占比例过高的文档"
+    name = 'dup_line'
+
+    def __init__(self, max_dup_fraction=0.3, max_dup_char_fraction=0.3):
+        self.max_dup_fraction = max_dup_fraction
+        self.max_dup_char_fraction = max_dup_char_fraction
+
+    def __call__(self, doc):
+        if doc.line_duplicates is None:
             return False
-        
-    # for ngram 5-10
-    duplicate_ngram_character_fractions = [
-        (5, 0.15),
-        (6, 0.14),
-        (7, 0.13),
-        (8, 0.12),
-        (9, 0.11),
-        (10, 0.10),
-    ]
-    for n, threshold in duplicate_ngram_character_fractions:
-        fdist = {}
-        mark = [0] * len(word_list)
-        for i in range(len(word_list) - n + 1):
-            bag = tuple(word_list[i: i + n])
-            if bag in fdist:
-                for j in range(i, i + n):
-                    mark[j] = len(word_list[j])
-                fdist[bag] += 1
-            else:
-                fdist[bag] = 1
-
-        if sum(mark) / n_chars > threshold:
+        dup_fraction, dup_char_fraction = doc.line_duplicates
+        return dup_fraction <= self.max_dup_fraction and dup_char_fraction <= self.max_dup_char_fraction
+
+class DuplicateParagraphRule(Rule):
+    "删除重复段落或重复段落字符所占比例过高的文档, 段落以空行分隔"
+    name = 'dup_paragraph'
+
+    def __init__(self, max_dup_fraction=0.3, max_dup_char_fraction=0.2):
+        self.max_dup_fraction = max_dup_fraction
+        self.max_dup_char_fraction = max_dup_char_fraction
+
+    def __call__(self, doc):
+        if doc.paragraph_duplicates is None:
             return False
-        
-    # if is_bad_doc(text, badwords):
-    #     return False
-    
-    return True
+        dup_fraction, dup_char_fraction = doc.paragraph_duplicates
+        return dup_fraction <= self.max_dup_fraction and dup_char_fraction <= self.max_dup_char_fraction
+
+class TopNgramRule(Rule):
+    "删除单个 2~4-gram 重复字符所占比例过高的文档"
+    name = 'top_ngram'
+
+    def __init__(self, fractions=top_ngram_character_fractions):
+        self.fractions = fractions
+
+    def __call__(self, doc):
+        n_chars = doc.word_lens.sum()
+        if n_chars == 0:
+            return False
+        for n, threshold in self.fractions:
+            if len(doc.word_ids) < n:
+                break
+            fraction = top_ngram_fraction(doc.ngram_hashes(n), n, doc.word_line_ids, doc.ngram_char_sums(n), n_chars)
+            if fraction > threshold:
+                return False
+        return True
+
+class DuplicateNgramRule(Rule):
+    "删除重复 5~10-gram 覆盖的字符所占比例过高的文档"
+    name = 'dup_ngram'
+
+    def __init__(self, fractions=duplicate_ngram_character_fractions):
+        self.fractions = fractions
+
+    def __call__(self, doc):
+        n_chars = doc.word_lens.sum()
+        if n_chars == 0:
+            return False
+        for n, threshold in self.fractions:
+            if len(doc.word_ids) < n:
+                break
+            if duplicate_ngram_fraction(doc.ngram_hashes(n), n, doc.word_lens, n_chars) > threshold:
+                return False
+        return True
+
+class FlaggedWordsRule(Rule):
+    "删除包含过多敏感词的文档"
+    name = 'flagged_words'
+
+    def __init__(self, threshold=3):
+        self.threshold = threshold
+
+    def __call__(self, doc):
+        return not is_bad_doc(doc.text, doc.languages, self.threshold)
+
+class FilterCascade:
+    """run the rules one after another and stop at the first one rejecting the document
+
+    Every reorder_interval documents the rules are sorted by their measured seconds per
+    rejection, so the cheap rules that reject many documents run before tokenization.
+    """
+    def __init__(self, rules, reorder_interval=1000):
+        self.rules = list(rules)
+        self.reorder_interval = reorder_interval
+        self.n_docs = 0
+        # 每个规则的 [调用次数, 删除次数, 耗时]
+        self.stats = {rule.name: [0, 0, 0.0] for rule in self.rules}
+
+    def __call__(self, item):
+        "the name of the rule rejecting item, None if it passes every rule"
+        doc = Document(item)
+        rejected_by = None
+        for rule in self.rules:
+            start = time.perf_counter()
+            passed = rule(doc)
+            stats = self.stats[rule.name]
+            stats[0] += 1
+            stats[2] += time.perf_counter() - start
+            if not passed:
+                stats[1] += 1
+                rejected_by = rule.name
+                break
+        self.n_docs += 1
+        if self.reorder_interval and self.n_docs % self.reorder_interval == 0:
+            self.reorder()
+        return rejected_by
+
+    def cost_per_rejection(self, rule):
+        calls, rejects, seconds = self.stats[rule.name]
+        if calls == 0:
+            # 还没有测过的规则先跑, 下一轮就有数据了
+            return 0.0
+        return (seconds / calls) / ((rejects + 1) / (calls + 1))
+
+    def reorder(self):
+        self.rules.sort(key=self.cost_per_rejection)
+
+def build_cascade(args):
+    rules = [
+        LengthRule(),
+        DuplicateLineRule(),
+        DuplicateParagraphRule(),
+        TopNgramRule(),
+        DuplicateNgramRule(),
+    ]
+    if args.flagged_words:
+        rules.append(FlaggedWordsRule())
+    return FilterCascade(rules, reorder_interval=args.reorder_interval)
+
+cascade = None
+
+def init_worker(args):
+    # 每个进程有自己的规则顺序和耗时统计
+    global cascade
+    cascade = build_cascade(args)
 
 def worker(line):
-    item = json.loads(line)
-    flag = process(item)
-    return item, flag
+    "only the verdict goes back, the parent writes the original line"
+    return cascade(json.loads(line))
+
+def count_done_records(output_dir, prefix):
+    """records in the finished <prefix>_<n> files of an interrupted run, the files
+    that are not in the manifest are removed"""
+    finished = {entry['path']: entry['records'] for entry in read_manifest(output_dir)}
+    num_done = 0
+    for fn in os.listdir(output_dir):
+        name = strip_extension(fn[:-len('.tmp')] if fn.endswith('.tmp') else fn)
+        if not name.startswith(prefix + '_') or not name[len(prefix) + 1:].isdigit():
+            continue
+        if fn in finished:
+            num_done += finished[fn]
+        else:
+            os.remove(os.path.join(output_dir, fn))
+    return num_done
 
 if __name__ == '__main__':
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument("--data_dir", required=True)
     parser.add_argument("--output_dir", required=True)
+    parser.add_argument("--num_workers", default=num_workers, type=int)
+    parser.add_argument("--watch", action="store_true", help="Keep filtering the shards added to the manifest of --data_dir until it is marked done.")
+    parser.add_argument("--flagged_words", action="store_true", help="Also drop the documents with more than 3 flagged words of their languages.")
+    parser.add_argument("--reorder_interval", default=1000, type=int, help="Re-sort the rules by measured cost per rejection every this many documents per worker, 0 keeps the default order.")
+    parser.add_argument("--batch_size", default=10000, type=int, help="Number of lines read ahead and submitted to the workers at once.")
+    parser.add_argument("--chunksize", default=64, type=int, help="Number of lines sent to a worker per task.")
+    parser.add_argument("--max_items", default=50000, type=int, help="Number of records per output file. A restart re-filters the input shard but does not write the records of the finished output files again.")
+    add_codec_args(parser)
     args = parser.parse_args()
+    exit_on_sigterm()
     
-    files = os.listdir(args.data_dir)
-    pool = Pool(num_workers)
-    os.makedirs(args.output_dir)
-    for fn in files:
-        if not fn.endswith('.gz'):
+    if args.watch:
+        files = watch_shards(args.data_dir)
+    else:
+        files = [os.path.join(args.data_dir, fn) for fn in os.listdir(args.data_dir)]
+    pool = Pool(args.num_workers, initializer=init_worker, initargs=(args,))
+    os.makedirs(args.output_dir, exist_ok=True)
+    clear_done(args.output_dir)
+    already_done_path = os.path.join(args.output_dir, 'already_done.paths')
+    already_done = set()
+    if os.path.exists(already_done_path):
+        with open(already_done_path, 'r', encoding='utf-8') as fp:
+            already_done = set(line.strip() for line in fp)
+    total_rejected = Counter()
+    for dataset_name in files:
+        fn = os.path.basename(dataset_name)
+        if not is_data_file(fn) or fn in already_done:
             continue
-        fp = io.BytesIO()
-        dataset_name = os.path.join(args.data_dir, fn)
-        output_path = os.path.join(args.output_dir, fn)
-        print(f'processing {dataset_name}, saving to {output_path}')
-        for item, flag in tqdm(pool.imap(worker, load_file(dataset_name))):
-            if flag:
-                fp.write(json.dumps(item, ensure_ascii=False).encode('utf-8'))
-                fp.write(b'\n')
-                    
-        with gzip.open(output_path, 'wb') as out_fp:
-            out_fp.write(fp.getvalue())
+        prefix = strip_extension(fn)
+        # 上次中断前已经写完的记录不再写
+        num_done = count_done_records(args.output_dir, prefix)
+        writer = Writer(args.output_dir, prefix=prefix, offset=next_index(args.output_dir, prefix),
+                        max_items=args.max_items, codec=args.codec, level=args.compress_level)
+        print(f'processing {dataset_name}, saving to {os.path.join(args.output_dir, prefix)}_*')
+        rejected = Counter()
+        try:
+            for line, rejected_by in tqdm(map_windows(pool, worker, load_file(dataset_name), args.batch_size, args.chunksize)):
+                if rejected_by is None:
+                    if num_done:
+                        num_done -= 1
+                    else:
+                        writer.write_line(line)
+                rejected[rejected_by] += 1
+        finally:
+            # 写完的记录是输入的前缀, 出错时也提交
+            writer.close()
+        with open(already_done_path, 'a', encoding='utf-8') as fp:
+            fp.write(fn + '\n')
+        kept = rejected.pop(None, 0)
+        print(f'{fn}: kept {kept} of {kept + sum(rejected.values())}, rejected by ' + ', '.join(f'{name} {n}' for name, n in rejected.most_common()))
+        total_rejected.update(rejected)
+    mark_done(args.output_dir)
+    print('rejected by ' + ', '.join(f'{name} {n}' for name, n in total_rejected.most_common()))
@@ -0,0 +1,201 @@
+# Copyright (c) 2022 Jianbin Chang
+
+import argparse
+import fcntl
+import hashlib
+import json
+import mmap
+import os
+import unicodedata
+from collections import Counter
+from multiprocessing import Pool
+
+import numpy as np
+from tqdm import tqdm
+from utils import CODECS, Shard, add_codec_args, clear_done, exit_on_sigterm, is_data_file, map_windows, mark_done, open_file, read_manifest, strip_extension, watch_shards
+
+INDEX_NAME = 'content_hashes.u64'
+
+def normalize(text):
+    "NFKC, lower case and single spaces, so pages differing only in whitespace or width are duplicates"
+    return ' '.join(unicodedata.normalize('NFKC', text).lower().split())
+
+def content_hash(line):
+    "the 8-byte blake2b of the normalized content of a record, never 0"
+    item = json.loads(line)
+    digest = hashlib.blake2b(normalize(item.get('content', '') or '').encode('utf-8'), digest_size=8).digest()
+    # 0 表示空槽
+    return int.from_bytes(digest, 'little') or 1
+
+class HashIndex:
+    """an open-addressing (linear probing) set of 64-bit hashes in a memory-mapped file,
+    kept across runs; the table doubles once it is more than max_load full"""
+    def __init__(self, index_dir, capacity=2**24, max_load=0.5):
+        os.makedirs(index_dir, exist_ok=True)
+        self.path = os.path.join(index_dir, INDEX_NAME)
+        self.max_load = max_load
+        # 同一个索引只能有一个进程在写
+        self._lock = open(os.path.join(index_dir, INDEX_NAME + '.lock'), 'w')
+        try:
+            fcntl.flock(self._lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            print(f'{index_dir} is used by another process')
+            raise
+        if not os.path.exists(self.path):
+            # 稀疏文件, 只有写过的页才占空间
+            with open(self.path, 'wb') as fp:
+                fp.truncate(capacity * 8)
+        self._open()
+        self.count = int(np.count_nonzero(np.frombuffer(self._mmap, dtype=np.uint64)))
+
+    def _open(self):
+        self._fp = open(self.path, 'r+b')
+        self._mmap = mmap.mmap(self._fp.fileno(), 0)
+        self._slots = memoryview(self._mmap).cast('Q')
+        self.capacity = len(self._slots)
+        self._mask = self.capacity - 1
+
+    def _close(self):
+        self._slots.release()
+        self._mmap.close()
+        self._fp.close()
+
+    def __contains__(self, h):
+        slots = self._slots
+        i = h & self._mask
+        while 1:
+            value = slots[i]
+            if value == h:
+                return True
+            if value == 0:
+                return False
+            i = (i + 1) & self._mask
+
+    def add(self, h):
+        if (self.count + 1) > self.capacity * self.max_load:
+            self._grow()
+        slots = self._slots
+        i = h & self._mask
+        while 1:
+            value = slots[i]
+            if value == h:
+                return
+            if value == 0:
+                slots[i] = h
+                self.count += 1
+                return
+            i = (i + 1) & self._mask
+
+    def _grow(self):
+        keys = np.frombuffer(self._mmap, dtype=np.uint64)
+        keys = keys[keys != 0].copy()
+        capacity = self.capacity * 2
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as fp:
+            fp.truncate(capacity * 8)
+        table = np.memmap(tmp_path, dtype=np.uint64, mode='r+', shape=(capacity,))
+        mask = np.uint64(capacity - 1)
+        pos = keys & mask
+        # 所有键一起探测: 每轮每个空槽只放一个键, 没放下的键移到下一个槽
+        while len(keys):
+            free = np.nonzero(table[pos] == 0)[0]
+            _, first = np.unique(pos[free], return_index=True)
+            placed = free[first]
+            table[pos[placed]] = keys[placed]
+            left = np.ones(len(keys), dtype=bool)
+            left[placed] = False
+            keys = keys[left]
+            pos = (pos[left] + np.uint64(1)) & mask
+        table.flush()
+        del table
+        self._close()
+        os.replace(tmp_path, self.path)
+        self._open()
+        print(f'hash index grown to {self.capacity} slots')
+
+    def flush(self):
+        self._mmap.flush()
+
+    def close(self):
+        self.flush()
+        self._close()
+        self._lock.close()
+
+def restore_hashes(pool, output_path, index, args):
+    "an output file committed before its hashes were added to the index"
+    with open_file(output_path, 'rb') as fp:
+        for line, h in map_windows(pool, content_hash, fp, args.batch_size, args.chunksize):
+            index.add(h)
+    index.flush()
+
+def dedup_shard(pool, path, output_path, index, args):
+    """copy the records of path whose content is not in the index to output_path; the hashes
+    of the shard are only added to the index after its output file is committed, so a crash
+    never leaves a hash in the index without its record"""
+    pending = set()
+    num_dropped = 0
+    shard = Shard(output_path, args.codec, args.compress_level)
+    with open_file(path, 'rb') as fp:
+        for line, h in tqdm(map_windows(pool, content_hash, fp, args.batch_size, args.chunksize)):
+            if h in pending or h in index:
+                num_dropped += 1
+                continue
+            pending.add(h)
+            shard.write_line(line)
+    shard.close()
+    for h in pending:
+        index.add(h)
+    index.flush()
+    return len(pending), num_dropped
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Drop the records whose normalized content was already seen, in this run or in earlier runs sharing --index_dir.")
+    parser.add_argument("--data_dir", required=True)
+    parser.add_argument("--output_dir", required=True)
+    parser.add_argument("--index_dir", required=True, help="The directory of the content hash index, reuse it across snapshots to drop pages seen before.")
+    parser.add_argument("--index_capacity", default=2**24, type=int, help="Initial number of slots of a new index, a power of 2; the index doubles when half full.")
+    parser.add_argument("--num_workers", default=8, type=int, help="Processes parsing and hashing the records.")
+    parser.add_argument("--batch_size", default=10000, type=int)
+    parser.add_argument("--chunksize", default=256, type=int)
+    parser.add_argument("--watch", action="store_true", help="Keep deduplicating the shards added to the manifest of --data_dir until it is marked done.")
+    add_codec_args(parser)
+    args = parser.parse_args()
+    assert args.index_capacity & (args.index_capacity - 1) == 0, '--index_capacity must be a power of 2'
+    exit_on_sigterm()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    clear_done(args.output_dir)
+    index = HashIndex(args.index_dir, args.index_capacity)
+    print(f'hash index with {index.count} hashes in {index.capacity} slots')
+    already_done_path = os.path.join(args.output_dir, 'already_done.paths')
+    already_done = set()
+    if os.path.exists(already_done_path):
+        with open(already_done_path, 'r', encoding='utf-8') as fp:
+            already_done = set(line.strip() for line in fp)
+
+    if args.watch:
+        files = watch_shards(args.data_dir)
+    else:
+        files = [os.path.join(args.data_dir, fn) for fn in os.listdir(args.data_dir)]
+    pool = Pool(args.num_workers)
+    total = Counter()
+    for path in files:
+        fn = os.path.basename(path)
+        if not is_data_file(fn) or fn in already_done:
+            continue
+        output_fn = strip_extension(fn) + CODECS[args.codec]
+        output_path = os.path.join(args.output_dir, output_fn)
+        if output_fn in set(entry['path'] for entry in read_manifest(args.output_dir)):
+            # 上次在提交输出之后、记录 already_done 之前中断
+            restore_hashes(pool, output_path, index, args)
+        else:
+            print(f'processing {path}, saving to {output_path}')
+            num_kept, num_dropped = dedup_shard(pool, path, output_path, index, args)
+            print(f'{fn}: kept {num_kept}, dropped {num_dropped} duplicates')
+            total['kept'] += num_kept
+            total['dropped'] += num_dropped
+        with open(already_done_path, 'a', encoding='utf-8') as fp:
+            fp.write(fn + '\n')
+    index.close()
+    mark_done(args.output_dir)
+    print(f'kept {total["kept"]}, dropped {total["dropped"]} duplicates, {index.count} hashes in the index')
@@ -0,0 +1,289 @@
+# Copyright (c) 2022 Jianbin Chang
+
+import argparse
+import json
+import os
+from multiprocessing import Pool
+
+import numpy as np
+from tqdm import tqdm
+from dedup_exact import normalize
+from utils import CODECS, Shard, add_codec_args, clear_done, exit_on_sigterm, is_data_file, mark_done, open_file, read_manifest, strip_extension, watch_shards
+
+# 1. 每个 worker 计算一个输入文件的 MinHash, 主进程把每个 band 的键按桶分片追加到磁盘
+# 2. 每个桶分片单独排序, 同一个键的文档连成边
+# 3. 主进程对所有边做并查集, 每个簇保留 id 最小的文档
+# 4. 每个 worker 重写一个输入文件
+
+_MERSENNE = np.uint64((1 << 61) - 1)
+_MAX_HASH = np.uint64((1 << 61) - 1)
+_SHINGLE_BASE = np.uint64(0x100000001B3)
+_LOW_32 = np.uint64(0xFFFFFFFF)
+_LOW_29 = np.uint64((1 << 29) - 1)
+# 桶分片文件里的一条记录: 带 band 的键和文档 id (输入文件编号 << 32 | 行号)
+BUCKET_DTYPE = np.dtype([('key', '<u8'), ('doc', '<u8')])
+EDGE_DTYPE = np.dtype([('u', '<u8'), ('v', '<u8')])
+PROGRESS_NAME = 'progress.jsonl'
+
+def shingle_hashes(text, shingle_size):
+    "the distinct 32-bit hashes of the character shingle_size-grams of text"
+    codepoints = np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32).astype(np.uint64)
+    if len(codepoints) == 0:
+        return codepoints
+    k = min(shingle_size, len(codepoints))
+    n = len(codepoints) - k + 1
+    hashes = np.zeros(n, dtype=np.uint64)
+    for j in range(k):
+        hashes = hashes * _SHINGLE_BASE + codepoints[j:n + j]
+    # 折叠到 32 位
+    return np.unique((hashes >> np.uint64(32)) ^ (hashes & _LOW_32))
+
+def _mod_mersenne(v):
+    "v % (2^61 - 1) for v < 2^64"
+    v = (v & _MERSENNE) + (v >> np.uint64(61))
+    return np.where(v >= _MERSENNE, v - _MERSENNE, v)
+
+def minhash(shingles, a, b, chunk_size):
+    """min over the shingles of (a * x + b) % (2^61 - 1) for every permutation, chunk_size
+    shingles at a time; a < 2^61 and x < 2^32, a * x is split so that nothing overflows"""
+    a_high = a >> np.uint64(32)
+    a_low = a & _LOW_32
+    signature = np.full(len(a), _MAX_HASH, dtype=np.uint64)
+    for start in range(0, len(shingles), chunk_size):
+        x = shingles[start:start + chunk_size, None]
+        # a * x = (a_high * x) * 2^32 + a_low * x, 且 2^61 = 1 (mod 2^61 - 1)
+        high = x * a_high
+        high = (high >> np.uint64(29)) + ((high & _LOW_29) << np.uint64(32))
+        values = _mod_mersenne(high + _mod_mersenne(x * a_low) + b)
+        np.minimum(signature, values.min(axis=0), out=signature)
+    return signature
+
+class MinHasher:
+    def __init__(self, num_perm=128, bands=16, shingle_size=5, seed=42, chunk_size=2048):
+        assert num_perm % bands == 0, 'num_perm must be a multiple of bands'
+        rng = np.random.RandomState(seed)
+        self.a = rng.randint(1, (1 << 61) - 1, size=num_perm, dtype=np.uint64)
+        self.b = rng.randint(0, (1 << 61) - 1, size=num_perm, dtype=np.uint64)
+        self.rows = num_perm // bands
+        # 每个 band 的 rows 个值乘上随机奇数求和 (uint64 回绕), 再混入 band 编号
+        self.row_mults = rng.randint(1, 1 << 63, size=self.rows, dtype=np.uint64) | np.uint64(1)
+        self.band_salts = rng.randint(0, 1 << 63, size=bands, dtype=np.uint64)
+        self.bands = bands
+        self.shingle_size = shingle_size
+        self.chunk_size = chunk_size
+
+    def band_keys(self, text):
+        "one 64-bit key per band, None for a text without shingles"
+        shingles = shingle_hashes(normalize(text), self.shingle_size)
+        if len(shingles) == 0:
+            return None
+        signature = minhash(shingles, self.a, self.b, self.chunk_size)
+        keys = (signature.reshape(self.bands, self.rows) * self.row_mults).sum(axis=1, dtype=np.uint64)
+        return keys ^ self.band_salts
+
+hasher = None
+
+def init_worker(args):
+    global hasher
+    hasher = MinHasher(args.num_perm, args.bands, args.shingle_size, args.seed)
+
+def hash_shard(task):
+    "the band keys of every record of one input shard"
+    shard_no, path = task
+    keys = []
+    docs = []
+    num_records = 0
+    with open_file(path, 'rb') as fp:
+        for line_no, line in enumerate(fp):
+            num_records += 1
+            band_keys = hasher.band_keys(json.loads(line).get('content', '') or '')
+            if band_keys is None:
+                continue
+            keys.append(band_keys)
+            docs.append(np.full(len(band_keys), (shard_no << 32) | line_no, dtype=np.uint64))
+    records = np.empty(sum(len(k) for k in keys), dtype=BUCKET_DTYPE)
+    if keys:
+        records['key'] = np.concatenate(keys)
+        records['doc'] = np.concatenate(docs)
+    return shard_no, path, num_records, records
+
+def bucket_path(work_dir, bucket):
+    return os.path.join(work_dir, f'bucket_{bucket}.bin')
+
+def edges_path(work_dir, bucket):
+    return os.path.join(work_dir, f'edges_{bucket}.npy')
+
+def read_progress(work_dir):
+    """the input shards whose band keys are in the bucket files, and the sizes of the bucket
+    files after the last of them; bytes after these sizes are from an interrupted shard"""
+    path = os.path.join(work_dir, PROGRESS_NAME)
+    entries = []
+    if os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as fp:
+            for line in fp:
+                if line.endswith('\n'):
+                    entries.append(json.loads(line))
+    return entries
+
+def spill_keys(work_dir, num_buckets, paths, args):
+    "phase 1: band keys of every input shard appended to num_buckets bucket files"
+    progress = read_progress(work_dir)
+    done = set(entry['path'] for entry in progress)
+    sizes = progress[-1]['sizes'] if progress else [0] * num_buckets
+    bucket_fps = []
+    for bucket in range(num_buckets):
+        fp = open(bucket_path(work_dir, bucket), 'ab')
+        # 去掉上次中断时只写了一半的输入文件
+        fp.truncate(sizes[bucket])
+        bucket_fps.append(fp)
+    next_shard_no = max([entry['shard_no'] for entry in progress], default=-1) + 1
+    tasks = ((next_shard_no + i, path) for i, path in enumerate(path for path in paths if path not in done))
+
+    # 去掉最后一行没写完的记录
+    progress_path = os.path.join(work_dir, PROGRESS_NAME)
+    with open(progress_path + '.tmp', 'w', encoding='utf-8') as fp:
+        fp.write(''.join(json.dumps(entry) + '\n' for entry in progress))
+    os.replace(progress_path + '.tmp', progress_path)
+    progress_fp = open(progress_path, 'a', encoding='utf-8')
+    num_spilled = 0
+    with Pool(args.num_workers, initializer=init_worker, initargs=(args,)) as pool:
+        for shard_no, path, num_records, records in tqdm(pool.imap_unordered(hash_shard, tasks), desc='minhash'):
+            buckets = records['key'] % np.uint64(num_buckets)
+            order = np.argsort(buckets, kind='stable')
+            bounds = np.searchsorted(buckets[order], np.arange(num_buckets + 1))
+            for bucket, fp in enumerate(bucket_fps):
+                records[order[bounds[bucket]:bounds[bucket + 1]]].tofile(fp)
+            for fp in bucket_fps:
+                fp.flush()
+                os.fsync(fp.fileno())
+            entry = {'path': path, 'shard_no': shard_no, 'records': num_records, 'sizes': [fp.tell() for fp in bucket_fps]}
+            progress_fp.write(json.dumps(entry) + '\n')
+            progress_fp.flush()
+            num_spilled += 1
+    for fp in bucket_fps:
+        fp.close()
+    progress_fp.close()
+    if num_spilled:
+        # 有新的输入时, 之前算好的边都要重算
+        for bucket in range(num_buckets):
+            if os.path.exists(edges_path(work_dir, bucket)):
+                os.remove(edges_path(work_dir, bucket))
+
+def bucket_edges(task):
+    "phase 2: documents sharing a band key are linked to the smallest of them"
+    work_dir, bucket = task
+    output_path = edges_path(work_dir, bucket)
+    if os.path.exists(output_path):
+        return bucket
+    records = np.fromfile(bucket_path(work_dir, bucket), dtype=BUCKET_DTYPE)
+    records.sort(order=['key', 'doc'])
+    first = np.ones(len(records), dtype=bool)
+    first[1:] = records['key'][1:] != records['key'][:-1]
+    # 每个键的第一条记录就是 id 最小的文档
+    group_first = records['doc'][first][np.cumsum(first) - 1]
+    linked = ~first & (records['doc'] != group_first)
+    edges = np.empty(np.count_nonzero(linked), dtype=EDGE_DTYPE)
+    edges['u'] = group_first[linked]
+    edges['v'] = records['doc'][linked]
+    edges = np.unique(edges)
+    with open(output_path + '.tmp', 'wb') as fp:
+        np.save(fp, edges)
+    os.replace(output_path + '.tmp', output_path)
+    return bucket
+
+def connected_components(edge_files, num_docs, to_dense):
+    """phase 3: union-find over the edge files, every document ends labeled with the
+    smallest dense id of its cluster"""
+    label = np.arange(num_docs, dtype=np.int64)
+    changed = True
+    while changed:
+        before = label.copy()
+        for path in edge_files:
+            edges = np.load(path)
+            u = label[to_dense(edges['u'])]
+            v = label[to_dense(edges['v'])]
+            smaller = np.minimum(u, v)
+            # 把两个根都挂到较小的根上
+            np.minimum.at(label, u, smaller)
+            np.minimum.at(label, v, smaller)
+            # 路径压缩, 直到每个文档都直接指向根
+            while True:
+                compressed = label[label]
+                if np.array_equal(compressed, label):
+                    break
+                label = compressed
+        changed = not np.array_equal(before, label)
+    return label
+
+def rewrite_shard(task):
+    "phase 4: copy the representatives of the clusters in one input shard"
+    path, output_path, keep, codec, level = task
+    num_kept = 0
+    shard = Shard(output_path, codec, level)
+    with open_file(path, 'rb') as fp:
+        for line_no, line in enumerate(fp):
+            if keep[line_no]:
+                shard.write_line(line)
+                num_kept += 1
+    shard.close()
+    return num_kept, len(keep) - num_kept
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Drop near-duplicate records with MinHash LSH, keeping the first record of every cluster.")
+    parser.add_argument("--data_dir", required=True)
+    parser.add_argument("--output_dir", required=True)
+    parser.add_argument("--work_dir", default=None, help="Bucket and edge files, default <output_dir>_minhash. Every phase resumes from it.")
+    parser.add_argument("--num_perm", default=128, type=int)
+    parser.add_argument("--bands", default=16, type=int, help="num_perm / bands rows per band; 16 x 8 finds pairs with Jaccard similarity above about 0.7.")
+    parser.add_argument("--shingle_size", default=5, type=int, help="Characters per shingle of the normalized content.")
+    parser.add_argument("--num_buckets", default=64, type=int, help="Number of bucket files; each is sorted in memory on its own and takes about 256 bytes per document / num_buckets on disk.")
+    parser.add_argument("--seed", default=42, type=int)
+    parser.add_argument("--num_workers", default=16, type=int, help="Processes hashing and rewriting the shards.")
+    parser.add_argument("--num_sort_workers", default=4, type=int, help="Processes sorting bucket files at once, each needs about 3.5 times the size of a bucket file in memory.")
+    parser.add_argument("--watch", action="store_true", help="Hash the shards added to the manifest of --data_dir as they come, and deduplicate once it is marked done.")
+    add_codec_args(parser)
+    args = parser.parse_args()
+    exit_on_sigterm()
+
+    work_dir = args.work_dir or args.output_dir.rstrip('/') + '_minhash'
+    os.makedirs(work_dir, exist_ok=True)
+    os.makedirs(args.output_dir, exist_ok=True)
+    clear_done(args.output_dir)
+
+    if args.watch:
+        paths = watch_shards(args.data_dir)
+    else:
+        paths = sorted(os.path.join(args.data_dir, fn) for fn in os.listdir(args.data_dir) if is_data_file(fn))
+    spill_keys(work_dir, args.num_buckets, paths, args)
+
+    # 每个 worker 要把一整个桶读进内存排序, 进程数单独控制
+    with Pool(args.num_sort_workers) as pool:
+        for bucket in tqdm(pool.imap_unordered(bucket_edges, [(work_dir, bucket) for bucket in range(args.num_buckets)]), desc='edges', total=args.num_buckets):
+            pass
+
+    progress = sorted(read_progress(work_dir), key=lambda entry: entry['shard_no'])
+    counts = np.zeros(progress[-1]['shard_no'] + 1 if progress else 0, dtype=np.int64)
+    for entry in progress:
+        counts[entry['shard_no']] = entry['records']
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    def to_dense(docs):
+        return offsets[(docs >> np.uint64(32)).astype(np.int64)] + (docs & _LOW_32).astype(np.int64)
+    label = connected_components([edges_path(work_dir, bucket) for bucket in range(args.num_buckets)], int(offsets[-1]), to_dense)
+    keep = label == np.arange(len(label))
+    print(f'{int(keep.sum())} of {len(keep)} records are the first of their cluster')
+
+    finished = set(entry['path'] for entry in read_manifest(args.output_dir))
+    tasks = []
+    for entry in progress:
+        output_fn = strip_extension(os.path.basename(entry['path'])) + CODECS[args.codec]
+        if output_fn in finished:
+            continue
+        start = offsets[entry['shard_no']]
+        tasks.append((entry['path'], os.path.join(args.output_dir, output_fn), keep[start:start + entry['records']], args.codec, args.compress_level))
+    num_kept = num_dropped = 0
+    with Pool(args.num_workers) as pool:
+        for kept, dropped in tqdm(pool.imap_unordered(rewrite_shard, tasks), desc='rewrite', total=len(tasks)):
+            num_kept += kept
+            num_dropped += dropped
+    mark_done(args.output_dir)
+    print(f'kept {num_kept}, dropped {num_dropped} near duplicates')
@@ -1,10 +1,14 @@
 # Copyright (c) 2022 Jianbin Chang
 
 import argparse
+import codecs
 import json
-import gzip
 import io
 import os
+import re
+import signal
+import sys
+from contextlib import closing
 
 import langdetect
 # import langid
@@ -12,18 +16,70 @@ import requests
 from tqdm import tqdm
 from warcio.archiveiterator import ArchiveIterator
 from subprocess import run
-from bs4 import BeautifulSoup
-from flagged_words import flagged_words
-from multiprocessing import Process, Manager, current_process
-
-badwords = flagged_words["zh"]
-badwords = frozenset(badwords)
+import lxml.html
+from lxml import etree
+from flagged_words_matcher import is_bad_doc
+from url_index import UrlFilter, UrlIndex, load_domains, url_hash
+from utils import Writer, add_codec_args, clear_done, compress_block, exit_on_sigterm, mark_done, next_index
+from multiprocessing import Process, Queue, current_process
+from queue import Empty
 
 CC_DOMAIN = "https://data.commoncrawl.org"
+HTTP_TIMEOUT = 60
+# persist the resume offset at least every this many compressed bytes
+CHECKPOINT_INTERVAL = 16 * 2**20
 
 NUM_FETCH_PROC = 30
 NUM_WRITE_PROCS = 1
 _CONTENT_LANGUAGE = "languages-cld2:"
+_HTML_PARSER = lxml.html.HTMLParser(encoding='utf-8')
+_HTML_TYPES = frozenset(['text/html', 'application/xhtml+xml'])
+MAX_PAYLOAD_BYTES = 5 * 2**20
+_CHARSET_PATTERN = re.compile(rb'''<meta[^>]+charset\s*=\s*["']?\s*([a-zA-Z0-9_\-]+)''', re.I)
+# 声明的编码按它的超集解码
+_CHARSET_ALIASES = {'gb2312': 'gb18030', 'gbk': 'gb18030', 'iso-8859-1': 'cp1252', 'latin1': 'cp1252', 'ascii': 'utf-8', 'us-ascii': 'utf-8'}
+
+def mime_type(content_type):
+    "text/html; charset=utf-8 -> text/html"
+    return content_type.split(';')[0].strip().lower() if content_type else ''
+
+def is_html_record(record, max_payload_bytes=MAX_PAYLOAD_BYTES):
+    "decide from the WARC and HTTP headers alone whether the payload is worth keeping and decoding"
+    payload_type = mime_type(record.rec_headers.get_header('WARC-Identified-Payload-Type'))
+    if payload_type and payload_type not in _HTML_TYPES:
+        return False
+    if record.http_headers is not None:
+        content_type = mime_type(record.http_headers.get_header('Content-Type'))
+        if content_type and content_type not in _HTML_TYPES:
+            return False
+    length = record.rec_headers.get_header('Content-Length')
+    if max_payload_bytes and length and length.isdigit() and int(length) > max_payload_bytes:
+        return False
+    return True
+
+def get_charset(content_type, payload):
+    "the charset of the HTTP Content-Type, else of a <meta> tag at the start of the page, else utf-8"
+    charset = None
+    if content_type and 'charset=' in content_type.lower():
+        charset = content_type.lower().split('charset=')[-1].split(';')[0].strip(' "\'')
+    if not charset:
+        match = _CHARSET_PATTERN.search(payload, 0, 4096)
+        if match:
+            charset = match.group(1).decode('ascii').lower()
+    charset = _CHARSET_ALIASES.get(charset, charset)
+    if charset:
+        try:
+            return codecs.lookup(charset).name
+        except LookupError:
+            pass
+    return 'utf-8'
+
+def decode_payload(payload, content_type=None):
+    "valid utf-8 is taken as is (charsets are often declared wrong), otherwise the declared charset is used"
+    try:
+        return payload.decode('utf-8')
+    except UnicodeDecodeError:
+        return payload.decode(get_charset(content_type, payload), errors='ignore')
 
 def parse_metadata(metadata):
     "get the languages info from the metadata of the WARC record"
@@ -51,137 +107,362 @@ def parse_wart_headers(rec_headers):
     return data
             
 
-def split_wart_file(wet_file_path):
+def checkpoint_path(watch_dir, path):
+    return os.path.join(watch_dir, 'checkpoints', os.path.basename(path) + '.offset')
+
+def load_checkpoint(watch_dir, path):
+    checkpoint_file = checkpoint_path(watch_dir, path)
+    if not os.path.exists(checkpoint_file):
+        return 0
+    with open(checkpoint_file, 'r', encoding='utf-8') as fp:
+        return int(fp.read().strip() or 0)
+
+class WarcCheckpoint:
+    """the resume offset of a WARC in a fetch worker; every block sent to the writers carries
+    an ack (path, seq, offset, url hashes), the main process persists the offset and the urls
+    once the block is in a finished shard (see WarcProgress)"""
+    def __init__(self, watch_dir, path, ack_queue=None):
+        self.warc_path = path
+        self.offset = load_checkpoint(watch_dir, path)
+        # the end of the last page handed to the writers, a retry resumes from it
+        self.sent_offset = self.offset
+        self.reported_offset = self.offset
+        # the end of the last page read, where commit() resumes
+        self.page_end = self.offset
+        # pages that are read but still buffered in the fetch worker
+        self.pending = False
+        self.seq = 0
+        self.ack_queue = ack_queue
+
+    def next_ack(self, offset, url_hashes=()):
+        "the ack of the next block of this WARC, offset None marks its end"
+        ack = (self.warc_path, self.seq, offset, list(url_hashes))
+        self.seq += 1
+        if offset is not None:
+            self.reported_offset = offset
+        return ack
+
+    def update(self, offset):
+        "called by split_wart_file at every record boundary with no pending page"
+        if self.pending:
+            return
+        self.offset = offset
+        if self.ack_queue is not None and offset - self.reported_offset >= CHECKPOINT_INTERVAL:
+            # 很长一段记录都没有保留的页面, 不经过写进程直接报告进度
+            self.ack_queue.put(('acks', [self.next_ack(offset)]))
+
+    def page_read(self, offset):
+        "called by split_wart_file before it yields a page that ends at offset"
+        self.page_end = offset
+
+    def hold(self):
+        "a page was read but is not handed to the writers yet, do not report offsets past it"
+        self.pending = True
+
+    def commit(self, url_hashes=()):
+        "the pages read so far are sent in one block, return the ack that goes with it"
+        self.offset = self.sent_offset = self.page_end
+        self.pending = False
+        return self.next_ack(self.offset, url_hashes)
+
+    def rollback(self):
+        "forget the pages that were read but not sent, a retry resumes after the last block sent"
+        if self.pending:
+            self.offset = self.sent_offset
+            self.pending = False
+
+    def finish(self):
+        "the ack of the end of the WARC, it is complete once all blocks before it are"
+        return self.next_ack(None)
+
+class WarcProgress:
+    """the acks of the main process: the checkpoint of a WARC only advances, and the WARC only
+    becomes SUCCESS, once all its blocks up to that point are in finished shards; blocks may be
+    acked out of order since several writers share the queue"""
+    def __init__(self, watch_dir, watch_fp, url_index=None):
+        self.watch_dir = watch_dir
+        self.watch_fp = watch_fp
+        self.url_index = url_index
+        # path -> [next seq to persist, {seq: offset} acked out of order]
+        self.states = {}
+
+    def ack(self, path, seq, offset, url_hashes):
+        "returns True once the WARC is complete"
+        if self.url_index is not None:
+            # 这个 block 已经在提交的文件里, 不用等它之前的 block
+            self.url_index.append('urls', url_hashes)
+        state = self.states.setdefault(path, [0, {}])
+        state[1][seq] = offset
+        resume_offset = None
+        finished = False
+        while state[0] in state[1]:
+            offset = state[1].pop(state[0])
+            state[0] += 1
+            if offset is None:
+                finished = True
+            else:
+                resume_offset = offset
+        if finished:
+            self.write_status(path, 'SUCCESS')
+            if os.path.exists(checkpoint_path(self.watch_dir, path)):
+                os.remove(checkpoint_path(self.watch_dir, path))
+            del self.states[path]
+        elif resume_offset is not None:
+            checkpoint_file = checkpoint_path(self.watch_dir, path)
+            with open(checkpoint_file + '.tmp', 'w', encoding='utf-8') as fp:
+                fp.write(f'{resume_offset}\n')
+            os.replace(checkpoint_file + '.tmp', checkpoint_file)
+        return finished
+
+    def write_status(self, path, status):
+        self.watch_fp.write(f'{path}\t{status}\n')
+        self.watch_fp.flush()
+
+def open_warc_stream(path, offset=0):
+    "open a WARC path (http(s), file:// or local file) as a raw compressed byte stream, starting at offset"
+    if path.startswith('http://') or path.startswith('https://'):
+        headers = {'Range': f'bytes={offset}-'} if offset else None
+        resp = requests.get(path, stream=True, headers=headers, timeout=HTTP_TIMEOUT)
+        if resp.status_code != (206 if offset else 200):
+            resp.close()
+            raise RuntimeError(f'下载失败 {path} (offset {offset}, status {resp.status_code})')
+        # warcio 按 gzip member 自行解压，这里保持原始字节
+        resp.raw.decode_content = False
+        return resp.raw
+    if path.startswith('file://'):
+        path = path[len('file://'):]
+    fp = open(path, 'rb')
+    fp.seek(offset)
+    return fp
+
+def split_wart_file(wet_file_path, stream=True, checkpoint=None, url_filter=None, max_payload_bytes=MAX_PAYLOAD_BYTES):
     page = {}
-    pid = current_process()._identity[0]
-    resp = requests.get(wet_file_path)
-    if resp.status_code != 200:
-        raise RuntimeError(f'下载失败 {wet_file_path}')
-    content = io.BytesIO(resp.content)
-    with gzip.GzipFile(fileobj=content) as fp:
-        for record in ArchiveIterator(fp, arc2warc=True):
+    start_offset = checkpoint.offset if checkpoint is not None else 0
+    with closing(open_warc_stream(wet_file_path, start_offset)) as raw:
+        if stream:
+            fp = raw
+        else:
+            # 旧的方式：先把整个 WARC 读入内存再解析
+            fp = io.BytesIO(raw.read())
+        records = ArchiveIterator(fp, arc2warc=True)
+        # 本地文件 seek 之后 warcio 从 fp.tell() 开始计数, HTTP 的 Range 响应从 0 开始
+        base_offset = records.offset
+        for record in records:
+            if checkpoint is not None and not page:
+                # 之前的记录都已经处理完，可以从这个 gzip member 处续传
+                # (records.offset 是当前记录的起始位置; get_record_offset() 会先读完整条记录)
+                checkpoint.update(start_offset + records.offset - base_offset)
             if record.rec_type == 'response':
-                # if record.http_headers.get_header('Content-Type') == 'text/html':
                 if len(page):
+                    if checkpoint is not None:
+                        # 没有 metadata 的页面在当前记录之前结束
+                        checkpoint.page_read(start_offset + records.offset - base_offset)
                     yield page
+                page = {}
+                if url_filter is not None and not url_filter(record.rec_headers.get_header('WARC-Target-URI')):
+                    # 不取内容也不解码, 下一次迭代时 warcio 读完 (解压) 并丢掉这条记录
+                    continue
+                if not is_html_record(record, max_payload_bytes):
+                    # 图片、PDF、超大文件不放进内存也不解码;
+                    # gzip 不能 seek, warcio 跳过记录时仍然会读完并解压它, 下载和解压的开销省不掉
+                    continue
+                payload = record.content_stream().read(max_payload_bytes + 1 if max_payload_bytes else -1)
+                if max_payload_bytes and len(payload) > max_payload_bytes:
+                    # 没有 Content-Length 的超大记录
+                    continue
                 # print(record.rec_headers)
                 page = parse_wart_headers(record.rec_headers)
-                page['content'] = record.content_stream().read().decode('utf-8', errors='ignore')
+                content_type = record.http_headers.get_header('Content-Type') if record.http_headers is not None else None
+                page['content'] = decode_payload(payload, content_type)
             elif record.rec_type == 'metadata':
                 if 'content' in page:
                     page['languages'] = parse_metadata(record.content_stream().read())
+                    if checkpoint is not None:
+                        # 这条 metadata 已经读完, 页面发出去之后从下一条记录续传
+                        checkpoint.page_read(start_offset + records.get_record_offset() + records.get_record_length() - base_offset)
                     yield page
                     page = {}
-    # os.remove(temp_path)
-
-def is_bad_doc(doc, badwords):
-    count = 0
-    for bad_word in badwords:
-        bad_word = bad_word.strip()
-        if bad_word in doc:
-            count += doc.count(bad_word)
-            if count > 3:
-                return True
-
-    return False
-
-def write_worker(pid, download_dir, out_queue):
-    file_index = 0
-    output_path = f'{download_dir}/raw_content_{file_index * NUM_WRITE_PROCS + pid}.jsonl.gz'
-    out_fp = gzip.open(output_path, 'wt', encoding='utf-8')
+
+def compress_batch(batch, codec='gzip', level=None):
+    "serialize and compress a batch of pages into one independent gzip member / zstd frame"
+    data = ''.join(json.dumps(page, ensure_ascii=False) + '\n' for page in batch)
+    return len(batch), compress_block(data.encode('utf-8'), codec, level)
+
+def write_worker(pid, download_dir, out_queue, ack_queue, args, first_index=0):
+    writer = Writer(download_dir, prefix='raw_content', offset=first_index + pid, strike=NUM_WRITE_PROCS,
+                    max_items=50000, codec=args.codec, level=args.compress_level)
     progress_bar = tqdm(position=pid, desc=f'Write Process {pid}')
-    num_items = 0
-    while 1:
-        page = out_queue.get()
-        if page is None:
-            break
-        out_fp.write(json.dumps(page, ensure_ascii=False))
-        out_fp.write('\n')
-        progress_bar.update()
-        num_items += 1
-        if num_items % 50000 == 0:
-            out_fp.close()
-            file_index += 1
-            output_path = f'{download_dir}/raw_content_{file_index * NUM_WRITE_PROCS + pid}.jsonl.gz'
-            out_fp = gzip.open(output_path, 'wt', encoding='utf-8')
-
-
-def process_worker(in_queue, out_queue, path_queue):
+    # 当前打开的文件里的 block 的 ack, 文件改名提交之后才发给主进程
+    acks = []
+    try:
+        while 1:
+            block = out_queue.get()
+            if block is None:
+                break
+            # fetch 进程已经压缩好的 gzip member / zstd frame，拼接起来仍然是合法的压缩文件
+            num_lines, data, ack = block
+            strike_idx = writer.strike_idx
+            writer.write_block(data, num_lines)
+            acks.append(ack)
+            if writer.strike_idx != strike_idx:
+                ack_queue.put(('acks', acks))
+                acks = []
+            progress_bar.update(num_lines)
+    finally:
+        # 被结束时也提交已经写入的 block, 主进程收到确认后再退出; 提交时不再被信号打断
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        writer.close()
+        ack_queue.put(('acks', acks))
+        ack_queue.put(('write_done', pid))
+
+
+def analyze_page(html):
+    "parse the html once, return its text and title (None if there is no title)"
+    try:
+        doc = lxml.html.document_fromstring(html.encode('utf-8'), parser=_HTML_PARSER)
+    except (etree.ParserError, ValueError):
+        # 空文档或者无法解析的内容
+        return '', None
+    title = doc.find('.//title')
+    if title is not None:
+        title = title.text_content()
+    return doc.text_content(), title
+
+def process_page(page, pid):
+    "detect the language and apply the flagged-word filter, return None if the page is dropped"
+    text = None
+    if "languages" not in page:
+        try:
+            text, title = analyze_page(page['content'])
+            # lang, prob = langid.classify(text)
+            lang = langdetect.detect(text)
+            if lang in ["zh-cn", "zh-tw"]:
+                lang = "zh"
+        except Exception as e:
+            print(pid, 'line:124', e)
+            return None
+        if lang in ["zh", "en"]:
+            page['languages'] = [lang]
+        else:
+            return None
+
+    if "zh" not in page['languages'] and "en" not in page['languages']:
+        return None
+    if text is None:
+        try:
+            text, title = analyze_page(page['content'])
+        except Exception as e:
+            print(pid, 'line:138', e)
+            return None
+    if is_bad_doc(text, page['languages']):
+        return None
+    if title is not None:
+        page['title'] = title
+    return page
+
+def fetch_warcs(in_queue, out_queue, ack_queue, args, url_filter=None):
     pid = current_process()._identity[0]
     while 1:
         path  = in_queue.get()
         if path is None:
-            # out_queue.put(None)
+            ack_queue.put(('fetch_done', pid))
             break
-        try:
-            for page in tqdm(split_wart_file(path), position=pid+1, desc=f"Process {pid}", disable=True):
-                if "languages" not in page:
-                    try:
-                        soup = BeautifulSoup(page['content'], 'lxml')
-                        text = soup.text
-                        # lang, prob = langid.classify(text)
-                        lang = langdetect.detect(text)
-                        if lang in ["zh-cn", "zh-tw"]:
-                            lang = "zh"
-                    except Exception as e:
-                        print(pid, 'line:124', e)
-                        continue
-                    if lang in ["zh", "en"]:
-                        page['languages'] = lang
-                    else:
+        checkpoint = WarcCheckpoint(args.watch_dir, path, ack_queue)
+        keep_urls = url_filter is not None and url_filter.index is not None
+        for attempt in range(args.num_retries + 1):
+            batch = []
+            kept_urls = []
+            try:
+                for page in tqdm(split_wart_file(path, stream=not args.no_stream, checkpoint=checkpoint, url_filter=url_filter, max_payload_bytes=args.max_payload_bytes), position=pid+1, desc=f"Process {pid}", disable=True):
+                    page = process_page(page, pid)
+                    if page is None:
                         continue
-                    
-                if "zh" not in page['languages'] and "en" not in page['languages']:
-                    continue
-                else:
-                    try:
-                        soup = BeautifulSoup(page['content'], 'lxml')
-                        text = soup.text
-                    except Exception as e:
-                        print(pid, 'line:138', e)
-                        continue
-                    # if is_bad_doc_v2(text, badwords, page['languages']):
-                    if is_bad_doc(text, badwords):
-                        continue
-                    if soup.title is not None:
-                        page['title'] = soup.title.text
-                        
-                out_queue.put(page)
-            path_queue.put((path, True))
-        except Exception as e:
-            print(pid, 'line:149', e)
-            path_queue.put((path, False))
+                    batch.append(page)
+                    if keep_urls and 'url' in page:
+                        kept_urls.append(url_hash(page['url']))
+                    checkpoint.hold()
+                    if len(batch) >= args.batch_size:
+                        # 队列满时阻塞，写进程跟不上时 fetch 进程会自动放慢
+                        # url 和续传位置一起随 block 确认, 没写进提交的文件的页面不会留在 url 索引里
+                        out_queue.put((*compress_batch(batch, args.codec, args.compress_level), checkpoint.commit(kept_urls)))
+                        batch = []
+                        kept_urls = []
+                if batch:
+                    out_queue.put((*compress_batch(batch, args.codec, args.compress_level), checkpoint.commit(kept_urls)))
+                # 之前的 block 都写进提交的文件之后, 主进程才把这个 WARC 记为 SUCCESS
+                ack_queue.put(('acks', [checkpoint.finish()]))
+                break
+            except Exception as e:
+                print(pid, 'line:149', f'attempt {attempt}', e)
+                # 丢弃还没发出去的页面，下次从最后一个发给写进程的 gzip member 续传
+                checkpoint.rollback()
+        else:
+            ack_queue.put(('failed', path))
+
+def process_worker(in_queue, out_queue, ack_queue, args, url_filter=None):
+    try:
+        fetch_warcs(in_queue, out_queue, ack_queue, args, url_filter)
+    except (SystemExit, KeyboardInterrupt):
+        # 被结束时写进程不再读队列, 退出时不等还没送出的 block, 它们没有确认, 下次重新下载
+        out_queue.cancel_join_thread()
+        raise
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--download_dir", help="The name of the directory to create and download WET files to.", required=True)
     parser.add_argument("--watch_dir", default="watch_cc", help="The directory to watch the downloading status")
     parser.add_argument("--paths", default="warc.paths.gz")
-    parser.add_argument("--num_write_procs", default=6, type=int)
+    parser.add_argument("--num_write_procs", default=2, type=int)
     parser.add_argument("--num_fetch_procs", default=6, type=int)
+    parser.add_argument("--cc_domain", default=CC_DOMAIN, help="Prefix of the WARC paths, e.g. file:///data/cc for local copies.")
+    parser.add_argument("--num_retries", default=3, type=int, help="How many times a failed WARC is resumed from its last checkpoint before it is marked FAILED.")
+    parser.add_argument("--batch_size", default=256, type=int, help="Number of pages a fetch process compresses into one block for the writers.")
+    parser.add_argument("--queue_size", default=64, type=int, help="Maximum number of blocks waiting for the writers.")
+    add_codec_args(parser)
+    parser.add_argument("--no_stream", action="store_true", help="Load each WARC fully into memory before parsing instead of streaming it.")
+    parser.add_argument("--max_payload_bytes", default=MAX_PAYLOAD_BYTES, type=int, help="Records larger than this are skipped without being buffered or decoded (they are still downloaded and decompressed), 0 for no limit.")
+    parser.add_argument("--url_index_dir", default=None, help="Hashes of the urls already kept, default <watch_dir>/url_index. Share it between snapshots to skip pages kept before.")
+    parser.add_argument("--no_url_index", action="store_true", help="Neither skip the urls in the index nor add the kept urls to it.")
+    parser.add_argument("--block_domains", default=None, help="A file of domains whose records are skipped, one per line; subdomains are skipped too.")
+    parser.add_argument("--allow_domains", default=None, help="A file of domains, only their records (and those of their subdomains) are read.")
     args = parser.parse_args()
+    exit_on_sigterm()
     NUM_WRITE_PROCS = args.num_write_procs
     NUM_FETCH_PROC = args.num_fetch_procs
     
     total_paths = []
     with open(args.paths, 'r', encoding='utf-8') as fp:
-        total_paths = [f'{CC_DOMAIN}/{line.strip()}' for line in fp.readlines()]
+        total_paths = [f'{args.cc_domain}/{line.strip()}' for line in fp.readlines()]
     
-    os.makedirs(args.download_dir)
+    os.makedirs(args.download_dir, exist_ok=True)
+    clear_done(args.download_dir)
+    for fn in os.listdir(args.download_dir):
+        if fn.endswith('.tmp'):
+            # 上次中断时没写完的文件, 其中的页面没有确认过, 会重新下载
+            os.remove(os.path.join(args.download_dir, fn))
+    # 重新运行时接着已有的文件编号写, 不覆盖上次的输出
+    first_index = next_index(args.download_dir, 'raw_content')
     os.makedirs(args.watch_dir, exist_ok=True)
+    os.makedirs(os.path.join(args.watch_dir, 'checkpoints'), exist_ok=True)
     file_idx = 0
     output_idx = 0
     
-    manager = Manager()
-    in_queue = manager.Queue()
-    out_queue = manager.Queue()
-    path_queue = manager.Queue()
+    in_queue = Queue()
+    out_queue = Queue(maxsize=args.queue_size)
+    ack_queue = Queue()
     
-    already_done_path = os.path.join(args.watch_dir, 'already_done.paths')
     already_done = []
-    if os.path.exists(already_done_path):
+    # complete.paths 是上次运行在同一个 watch_dir 里写完的文件
+    for fn in ['already_done.paths', 'complete.paths']:
+        already_done_path = os.path.join(args.watch_dir, fn)
+        if not os.path.exists(already_done_path):
+            continue
         with open(already_done_path, 'r', encoding='utf-8') as fp:
             for line in fp:
+                if not line.endswith('\n'):
+                    # 中断时没写完的最后一行
+                    continue
                 path, status = line.strip().split('\t')
                 if status == 'SUCCESS':
                     already_done.append(path)
@@ -191,40 +472,89 @@ if __name__ == "__main__":
         if path not in already_done:
             print(path)
             in_queue.put(path)
-    print(in_queue.qsize(), len(total_paths), len(already_done))
+    num_todo = in_queue.qsize()
+    print(num_todo, len(total_paths), len(already_done))
         
     procs = []
     writers = []
+    # 在 fork 之前加载, fetch 进程共享同一份只读的索引
+    url_index = None
+    if not args.no_url_index:
+        url_index = UrlIndex(args.url_index_dir or os.path.join(args.watch_dir, 'url_index'))
+        print(f'{len(url_index)} urls in the url index')
+    url_filter = UrlFilter(
+        url_index,
+        block_domains=load_domains(args.block_domains) if args.block_domains else frozenset(),
+        allow_domains=load_domains(args.allow_domains) if args.allow_domains else None,
+    )
+
     for i in range(NUM_FETCH_PROC):
         in_queue.put(None)
-        p = Process(target=process_worker, args=(in_queue, out_queue, path_queue))
+        p = Process(target=process_worker, args=(in_queue, out_queue, ack_queue, args, url_filter))
         p.start()
         procs.append(p)
         
     for i in range(NUM_WRITE_PROCS):
-        p = Process(target=write_worker, args=(i, args.download_dir, out_queue))
+        p = Process(target=write_worker, args=(i, args.download_dir, out_queue, ack_queue, args, first_index))
         p.start()
-        procs.append(p)
+        writers.append(p)
         
-    watch_fp = open(f'{args.watch_dir}/complete.paths', 'w', encoding='utf-8')
+    watch_fp = open(f'{args.watch_dir}/complete.paths', 'a', encoding='utf-8')
+    progress = WarcProgress(args.watch_dir, watch_fp, url_index)
     
-    num_finished = 0
-    file_progress_bar = tqdm(total_paths, desc="Finieshed Files")
-    while 1:
-        if num_finished + len(already_done) >= len(total_paths):
-            break
-        path, status = path_queue.get()
-        if not status:
-            watch_fp.write(f'{path}\tFAILED\n')
-            watch_fp.flush()
-        else:
-            watch_fp.write(f'{path}\tSUCCESS\n')
-            watch_fp.flush()
-        file_progress_bar.update()
-        num_finished += 1
-    for i in range(NUM_WRITE_PROCS):
-        out_queue.put(None)
-    for p in writers:
+    file_progress_bar = tqdm(total=num_todo, desc="Finieshed Files")
+    num_fetching = NUM_FETCH_PROC
+    num_writing = NUM_WRITE_PROCS
+    interrupted = None
+    while num_writing:
+        try:
+            try:
+                kind, value = ack_queue.get(timeout=60)
+            except Empty:
+                # 只用来发现被杀掉、没能发出结束消息的进程
+                if num_fetching and not any(p.is_alive() for p in procs):
+                    print('fetch workers exited without finishing')
+                    num_fetching = 0
+                    for i in range(NUM_WRITE_PROCS):
+                        out_queue.put(None)
+                if not any(p.is_alive() for p in writers):
+                    print('write workers exited without finishing')
+                    break
+                continue
+            if kind == 'acks':
+                for ack in value:
+                    if progress.ack(*ack):
+                        file_progress_bar.update()
+            elif kind == 'failed':
+                progress.write_status(value, 'FAILED')
+                file_progress_bar.update()
+            elif kind == 'fetch_done':
+                num_fetching -= 1
+                if num_fetching == 0:
+                    # 等 fetch 进程把剩余的 batch 都送进队列之后再通知写进程结束
+                    for p in procs:
+                        p.join()
+                    for i in range(NUM_WRITE_PROCS):
+                        out_queue.put(None)
+            elif kind == 'write_done':
+                num_writing -= 1
+        except (SystemExit, KeyboardInterrupt) as e:
+            if interrupted is not None:
+                raise
+            # 被结束时 (run_pipeline.py 会给整个进程组发 SIGTERM) 写进程提交打开的文件,
+            # 收下它们的确认再退出, 否则这些页面会被重新下载
+            interrupted = e
+            num_fetching = 0
+            for p in procs + writers:
+                p.terminate()
+    if interrupted is not None:
+        raise interrupted
+    for p in procs + writers:
         p.join()
+    if any(p.exitcode != 0 for p in procs + writers):
+        # 没确认的页面下次重新下载, 下游阶段不能认为下载已经结束
+        print('some workers failed, the download is not marked done')
+        sys.exit(1)
+    mark_done(args.download_dir)
 
     
\ No newline at end of file
@@ -0,0 +1,195 @@
+# Copyright (c) 2022 Jianbin Chang
+
+import argparse
+import json
+import os
+import sys
+
+from tqdm import tqdm
+from multiprocessing import Process, Queue, current_process
+from queue import Empty
+from threading import Thread
+from extractors import EXTRACTORS, get_extractor
+from utils import Writer, add_codec_args, clear_done, exit_on_sigterm, is_data_file, mark_done, next_index, open_file, read_manifest, strip_extension, watch_shards
+
+# 一条记录可能有多个语言, 按顺序取第一个匹配的
+LANGS = ['zh', 'en']
+
+NUM_FETCH_PROC = 40
+# NUM_WRITE_PROCS = 2
+
+def route(languages, langs):
+    "the language whose extractor configuration handles this record, None if the record is skipped"
+    for lang in LANGS:
+        if lang in languages:
+            return lang if lang in langs else None
+    return None
+
+def process_goose(item, extractor):
+    text = item.get('content', '')
+    try:
+        item['content'] = extractor.extract(text)
+    except Exception as e:
+        print(e)
+        item['content'] = ''
+    return item
+
+def feed_paths(paths, in_queue, num_procs):
+    for path in paths:
+        in_queue.put(path)
+    for i in range(num_procs):
+        in_queue.put(None)
+
+def load_done_ids(lang_dir, prefix):
+    """ids of the records already extracted into the finished <prefix>_<n> files of lang_dir;
+    files that are not in the manifest were interrupted and are removed"""
+    finished = frozenset(entry['path'] for entry in read_manifest(lang_dir))
+    done_ids = set()
+    for fn in os.listdir(lang_dir):
+        if not fn.startswith(prefix + '_'):
+            continue
+        path = os.path.join(lang_dir, fn)
+        if fn not in finished:
+            os.remove(path)
+            continue
+        with open_file(path, 'rb') as fp:
+            for line in fp:
+                done_ids.add(json.loads(line)['id'])
+    return done_ids
+
+def extract_shard(path, extractors, out_queue, args):
+    "extract one input shard into <output_dir>/<lang>/text_<input name>_<n> files"
+    prefix = 'text_' + strip_extension(os.path.basename(path))
+    writers = {}
+    done_ids = set()
+    for lang in args.langs:
+        lang_dir = os.path.join(args.output_dir, lang)
+        # 上次中断时已经写完的记录直接跳过
+        done_ids |= load_done_ids(lang_dir, prefix)
+        writers[lang] = Writer(lang_dir, prefix=prefix, offset=next_index(lang_dir, prefix),
+                               max_items=args.max_items, codec=args.codec, level=args.compress_level)
+    num_written = 0
+    try:
+        with open_file(path, 'rb') as fp:
+            for line in fp:
+                item = json.loads(line)
+                lang = route(item['languages'], args.langs)
+                if lang is None or item['id'] in done_ids:
+                    continue
+                item = process_goose(item, extractors[lang])
+                writers[lang].write_line(json.dumps(item, ensure_ascii=False))
+                num_written += 1
+                if num_written >= args.batch_size:
+                    # 只向主进程汇报进度
+                    out_queue.put(num_written)
+                    num_written = 0
+    finally:
+        # 已经抽取的记录都是完整的, 出错或者被结束时也提交, 下次只处理剩下的
+        for writer in writers.values():
+            writer.close()
+    # 被结束时主进程可能已经退出, 不能在 finally 里等待队列
+    if num_written:
+        out_queue.put(num_written)
+
+def worker(in_queue, out_queue, args):
+    # 每个进程自己创建抽取器, 不依赖 fork 继承的全局对象
+    extractors = {lang: get_extractor(args.extractor, lang) for lang in args.langs}
+    while 1:
+        path = in_queue.get()
+        if path is None:
+            # 每个 worker 结束时发一个 None, 主进程数够了就退出
+            out_queue.put(None)
+            break
+        try:
+            extract_shard(path, extractors, out_queue, args)
+            status = "SUCCESS"
+        except Exception as e:
+            print(e)
+            status = "FAILED"
+            # 失败的文件不算完成, 重新运行时接着抽取没写完的记录
+            out_queue.put(os.path.basename(path))
+        with open(os.path.join(args.output_dir, 'already_done.paths'), 'a', encoding='utf-8') as fp:
+            fn = os.path.basename(path)
+            fp.write(f'{fn}\t{status}\n')
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Extract the main text of the downloaded pages, reading every shard once for all languages.")
+    parser.add_argument("--data_dir", help="The directory of the downloaded raw_content files.", required=True)
+    parser.add_argument("--output_dir", default="watch_cc", help="The texts of each language are written to <output_dir>/<lang>.")
+    parser.add_argument("--langs", nargs='+', default=LANGS, choices=LANGS)
+    parser.add_argument("--extractor", default="goose", choices=sorted(EXTRACTORS), help="goose gives the best quality, lxml is a much faster text-density extractor, trafilatura needs the trafilatura package.")
+    parser.add_argument("--num_procs", default=NUM_FETCH_PROC, type=int)
+    parser.add_argument("--batch_size", default=64, type=int, help="Number of records after which a worker reports its progress.")
+    parser.add_argument("--queue_size", default=64, type=int, help="Maximum number of progress reports waiting for the main process.")
+    parser.add_argument("--max_items", default=10000, type=int, help="Number of records per output file. A restart re-extracts at most one unfinished file per input shard and language.")
+    parser.add_argument("--watch", action="store_true", help="Keep extracting the shards added to the manifest of --data_dir until it is marked done.")
+    add_codec_args(parser)
+    args = parser.parse_args()
+    exit_on_sigterm()
+
+    procs = []
+    in_queue = Queue(maxsize=2 * args.num_procs)
+    out_queue = Queue(maxsize=args.queue_size)
+
+    if not os.path.exists(args.output_dir):
+        os.makedirs(args.output_dir)
+        already_done = frozenset()
+    else:
+        already_done_path = os.path.join(args.output_dir, 'already_done.paths')
+        already_done = []
+        if os.path.exists(already_done_path):
+            with open(already_done_path, 'r', encoding='utf-8') as fp:
+                for line in fp:
+                    path, status = line.strip().split('\t')
+                    if status == 'SUCCESS':
+                        already_done.append(path)
+        already_done = frozenset(already_done)
+
+    if args.watch:
+        paths = watch_shards(args.data_dir)
+    else:
+        paths = [os.path.join(args.data_dir, fn) for fn in os.listdir(args.data_dir) if is_data_file(fn)]
+    paths = (path for path in paths if os.path.basename(path) not in already_done)
+    Thread(target=feed_paths, args=(paths, in_queue, args.num_procs), daemon=True).start()
+
+    for lang in args.langs:
+        os.makedirs(os.path.join(args.output_dir, lang), exist_ok=True)
+        clear_done(os.path.join(args.output_dir, lang))
+
+    for i in range(args.num_procs):
+        p = Process(target=worker, args=(in_queue, out_queue, args))
+        p.start()
+        procs.append(p)
+
+    progress_bar = tqdm(desc=f'extract text with {args.extractor}')
+    num_finished = 0
+    failed = []
+    while num_finished < len(procs):
+        try:
+            report = out_queue.get(timeout=60)
+        except Empty:
+            # 只用来发现被杀掉、没能发出结束标记的 worker
+            if not any([p.is_alive() for p in procs]):
+                print('all workers exited without finishing')
+                break
+            continue
+        # worker 发来的是抽取的记录数, 失败的输入文件名, 或者结束标记 None
+        if report is None:
+            num_finished += 1
+        elif isinstance(report, str):
+            failed.append(report)
+        else:
+            progress_bar.update(report)
+    for p in procs:
+        p.join()
+    if num_finished < len(procs) or any(p.exitcode != 0 for p in procs):
+        # 被杀掉的 worker 正在处理的文件没有抽取完, 下游阶段不能认为已经结束
+        print(f'{len(procs) - num_finished} of {len(procs)} workers exited without finishing, the outputs are not marked done')
+        sys.exit(1)
+    if failed:
+        print(f'{len(failed)} shards failed, the outputs are not marked done, run again to finish them:', ' '.join(failed))
+        sys.exit(1)
+    for lang in args.langs:
+        mark_done(os.path.join(args.output_dir, lang))
+    elapsed = progress_bar.format_dict['elapsed']
+    print(f'{args.extractor}: {progress_bar.n} docs in {elapsed:.0f}s, {progress_bar.n / max(elapsed, 1e-6):.1f} docs/s')
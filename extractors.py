@@ -0,0 +1,101 @@
+import re
+
+import lxml.html
+from lxml import etree
+
+# 正文抽取后端, 每个 worker 进程各自创建, 按语言区分配置
+_HTML_PARSER = lxml.html.HTMLParser(encoding='utf-8')
+
+class GooseExtractor:
+    "goose3, full DOM scoring, the best quality but the slowest"
+    def __init__(self, lang):
+        from goose3 import Goose
+        from goose3.text import StopWords, StopWordsChinese
+        stopwords = StopWordsChinese if lang == 'zh' else StopWords
+        self.goose = Goose({'stopwords_class': stopwords, 'parser_class': 'lxml', 'enable_image_fetching': False})
+
+    def extract(self, html):
+        return self.goose.extract(raw_html=html).cleaned_text
+
+class TrafilaturaExtractor:
+    "trafilatura, pip install trafilatura"
+    def __init__(self, lang):
+        import trafilatura
+        self.trafilatura = trafilatura
+        self.lang = lang
+
+    def extract(self, html):
+        return self.trafilatura.extract(html, include_comments=False, include_tables=False) or ''
+
+class LxmlExtractor:
+    """a light main-content extractor: drop boilerplate elements, keep the text blocks with
+    little link text and return those inside the container holding most of the text"""
+    DROP_TAGS = ['script', 'style', 'noscript', 'iframe', 'form', 'nav', 'header', 'footer', 'aside', 'button', 'select', 'svg']
+    BLOCK_TAGS = frozenset(['p', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'li', 'pre', 'blockquote', 'td', 'dd', 'dt', 'div', 'section', 'article'])
+    BOILERPLATE = re.compile(r'comment|footer|header|menu|nav|sidebar|breadcrumb|share|social|advert|related|copyright|banner|popup|cookie', re.I)
+    # 中文按字数, 其它语言的块需要更多字符
+    MIN_CHARS = {'zh': 10}
+    DEFAULT_MIN_CHARS = 40
+    MAX_LINK_DENSITY = 0.5
+
+    def __init__(self, lang):
+        self.min_chars = self.MIN_CHARS.get(lang, self.DEFAULT_MIN_CHARS)
+
+    def _is_boilerplate(self, el):
+        attrs = (el.get('class') or '') + ' ' + (el.get('id') or '')
+        return bool(attrs.strip()) and self.BOILERPLATE.search(attrs) is not None
+
+    def extract(self, html):
+        try:
+            doc = lxml.html.document_fromstring(html.encode('utf-8'), parser=_HTML_PARSER)
+        except (etree.ParserError, ValueError):
+            return ''
+        etree.strip_elements(doc, etree.Comment, *self.DROP_TAGS, with_tail=False)
+        for el in list(doc.iter('div', 'section', 'ul', 'table', 'span')):
+            if el.getparent() is not None and self._is_boilerplate(el):
+                el.drop_tree()
+
+        # 只取不包含其它块元素的叶子块
+        non_leaf = set()
+        blocks = [el for el in doc.iter() if el.tag in self.BLOCK_TAGS]
+        for el in blocks:
+            for parent in el.iterancestors():
+                if parent in non_leaf:
+                    break
+                non_leaf.add(parent)
+
+        kept = []
+        scores = {}
+        for el in blocks:
+            if el in non_leaf:
+                continue
+            text = ' '.join(el.text_content().split())
+            if len(text) < self.min_chars:
+                continue
+            link_chars = sum(len(a.text_content()) for a in el.iter('a'))
+            if link_chars / len(text) > self.MAX_LINK_DENSITY:
+                continue
+            kept.append((el, text))
+            parent = el.getparent()
+            if parent is not None:
+                scores[parent] = scores.get(parent, 0) + len(text)
+                grand_parent = parent.getparent()
+                if grand_parent is not None:
+                    scores[grand_parent] = scores.get(grand_parent, 0) + len(text) / 2
+        if not kept:
+            return ''
+        best = max(scores, key=scores.get) if scores else None
+        texts = []
+        for el, text in kept:
+            if best is None or el is best or best in el.iterancestors():
+                texts.append(text)
+        return '\n\n'.join(texts)
+
+EXTRACTORS = {
+    'goose': GooseExtractor,
+    'lxml': LxmlExtractor,
+    'trafilatura': TrafilaturaExtractor,
+}
+
+def get_extractor(name, lang):
+    return EXTRACTORS[name](lang)
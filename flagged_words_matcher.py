@@ -0,0 +1,98 @@
+import functools
+
+try:
+    import ahocorasick
+except ImportError:
+    # pip install pyahocorasick
+    ahocorasick = None
+
+from flagged_words import flagged_words, english_flagged_words
+
+# 不用空格分词的文字: 汉字、假名、谚文、泰文等
+_UNSEGMENTED_RANGES = [
+    (0x0E00, 0x0E7F),
+    (0x3040, 0x30FF),
+    (0x3400, 0x4DBF),
+    (0x4E00, 0x9FFF),
+    (0xAC00, 0xD7AF),
+    (0xF900, 0xFAFF),
+]
+
+def _is_unsegmented(ch):
+    code = ord(ch)
+    for lo, hi in _UNSEGMENTED_RANGES:
+        if lo <= code <= hi:
+            return True
+    return False
+
+def _is_word_char(ch):
+    "a character that continues a word of a space-delimited language"
+    return ch.isalnum() and not _is_unsegmented(ch)
+
+def normalize_lang(lang):
+    "zh-Hant, zh-cn -> zh"
+    return lang.replace('_', '-').split('-')[0].lower()
+
+class FlaggedWordsMatcher:
+    """count the occurrences of a set of flagged words in a single pass over the document
+
+    Words written in space-delimited scripts only match as whole words, so "cum" does
+    not fire inside "document"; words in Chinese/Japanese/Korean/Thai match anywhere.
+    """
+    def __init__(self, words):
+        self.words = sorted(frozenset(w.strip() for w in words if w.strip()))
+        self.whole_word = {w: not any(_is_unsegmented(ch) for ch in w) for w in self.words}
+        self._automaton = None
+        if ahocorasick is not None:
+            self._automaton = ahocorasick.Automaton()
+            for word in self.words:
+                self._automaton.add_word(word, (len(word), self.whole_word[word]))
+            self._automaton.make_automaton()
+
+    def _is_match(self, doc, start, end, whole_word):
+        if not whole_word:
+            return True
+        if start > 0 and _is_word_char(doc[start - 1]):
+            return False
+        if end < len(doc) and _is_word_char(doc[end]):
+            return False
+        return True
+
+    def count(self, doc, limit=None):
+        "number of flagged word occurrences in doc, stops counting once it exceeds limit"
+        count = 0
+        if self._automaton is not None:
+            for end, (length, whole_word) in self._automaton.iter(doc):
+                if self._is_match(doc, end + 1 - length, end + 1, whole_word):
+                    count += 1
+                    if limit is not None and count > limit:
+                        break
+            return count
+        # 没有安装 pyahocorasick 时逐个词扫描
+        for word in self.words:
+            start = doc.find(word)
+            while start != -1:
+                if self._is_match(doc, start, start + len(word), self.whole_word[word]):
+                    count += 1
+                    if limit is not None and count > limit:
+                        return count
+                start = doc.find(word, start + 1)
+        return count
+
+    def is_bad_doc(self, doc, threshold=3):
+        return self.count(doc, limit=threshold) > threshold
+
+@functools.lru_cache(maxsize=None)
+def get_matcher(langs=('zh',)):
+    "the matcher for the union of the flagged words of langs, built once per process"
+    words = set()
+    for lang in langs:
+        words.update(flagged_words.get(lang, english_flagged_words))
+    return FlaggedWordsMatcher(words)
+
+def is_bad_doc(doc, langs=('zh',), threshold=3):
+    "langs are the languages of the document, e.g. the cld2 codes in page['languages'], or a single code"
+    if isinstance(langs, str):
+        langs = (langs,)
+    langs = tuple(sorted(frozenset(normalize_lang(lang) for lang in langs))) or ('zh',)
+    return get_matcher(langs).is_bad_doc(doc, threshold)
@@ -1,29 +1,43 @@
 import os
 import argparse
+from utils import append_manifest, is_data_file, read_manifest, strip_extension
 
 NUM_WRITE_PROCS = 1
-file_name = "raw_content_{}.jsonl.gz"
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--download_dir", help="The name of the directory to create and download files to.", required=True)
     parser.add_argument("--output_dir", help="The name of the directory to move files to.", required=True)
-    parser.add_argument("--num_write_procs", default=6, type=int)
+    parser.add_argument("--num_write_procs", default=2, type=int)
     args = parser.parse_args()
     NUM_WRITE_PROCS = args.num_write_procs
     
     os.makedirs(args.output_dir, exist_ok=True)
     print(f'Moving files from {args.download_dir} to {args.output_dir}')
-    
+
+    manifest = read_manifest(args.download_dir)
+    if manifest:
+        # 写进程只把写完的文件记录到 manifest 里，可以直接移走
+        for entry in manifest:
+            fn = entry['path']
+            if not os.path.exists(os.path.join(args.download_dir, fn)):
+                continue
+            print('yes', fn)
+            os.rename(os.path.join(args.download_dir, fn), os.path.join(args.output_dir, fn))
+            append_manifest(args.output_dir, entry)
+        exit(0)
+
+    # 没有 manifest 的旧下载目录: 同一个写进程的下一个文件已经存在时才认为写完了
     already_done = []
-    all_indexes = []
+    all_indexes = {}
     for fn in sorted(os.listdir(args.download_dir)):
-        index = fn.replace('raw_content_', '').replace('.jsonl.gz', '')
+        if not is_data_file(fn):
+            continue
+        index = strip_extension(fn).replace('raw_content_', '')
         # print(index)
         index = int(index)
-        all_indexes.append(index)
-    for index in all_indexes:
-        fn = f"raw_content_{index}.jsonl.gz"
+        all_indexes[index] = fn
+    for index, fn in all_indexes.items():
         if index + NUM_WRITE_PROCS in all_indexes:
             print('yes', fn)
             os.rename(os.path.join(args.download_dir, fn), os.path.join(args.output_dir, fn))
@@ -0,0 +1,141 @@
+# Copyright (c) 2022 Jianbin Chang
+
+import argparse
+import os
+import signal
+import sys
+import time
+from subprocess import Popen
+from utils import clear_done, exit_on_sigterm
+
+def script_cmd(script, *args):
+    return [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), script)] + [str(a) for a in args]
+
+def codec_args(args):
+    cmd = ['--codec', args.codec]
+    if args.compress_level is not None:
+        cmd += ['--compress_level', args.compress_level]
+    return cmd
+
+def stop_stage(p):
+    "SIGTERM the stage and its worker processes, every stage runs in its own process group"
+    try:
+        os.killpg(p.pid, signal.SIGTERM)
+    except ProcessLookupError:
+        pass
+
+def build_stages(args):
+    "the name, command and output directories of every stage, each stage watches the manifest of the previous stage's output"
+    download_dir = os.path.join(args.work_dir, 'downloads')
+    stages = [('download', script_cmd(
+        'download_get_text_from_warc.py',
+        '--download_dir', download_dir,
+        '--watch_dir', os.path.join(args.work_dir, 'watch'),
+        '--paths', args.paths,
+        '--cc_domain', args.cc_domain,
+        '--num_fetch_procs', args.num_fetch_procs,
+        '--num_write_procs', args.num_write_procs,
+        *codec_args(args),
+    ), [download_dir])]
+    text_dir = os.path.join(args.work_dir, 'text')
+    stages.append(('extract', script_cmd(
+        'extract_text_fast.py',
+        '--data_dir', download_dir,
+        '--output_dir', text_dir,
+        '--langs', *args.langs,
+        '--extractor', args.extractor,
+        '--num_procs', args.num_extract_procs,
+        # 小一些的文件可以更早交给过滤阶段
+        '--max_items', args.extract_shard_size,
+        '--watch',
+        *codec_args(args),
+    ), [os.path.join(text_dir, lang) for lang in args.langs]))
+    for lang in args.langs:
+        dedup_dir = os.path.join(args.work_dir, f'{lang}_dedup_text')
+        # 先去掉完全重复的页面, 过滤阶段就不用再算它们的 ngram
+        stages.append((f'dedup_{lang}', script_cmd(
+            'dedup_exact.py',
+            '--data_dir', os.path.join(text_dir, lang),
+            '--output_dir', dedup_dir,
+            '--index_dir', os.path.join(args.dedup_index_dir or os.path.join(args.work_dir, 'dedup_index'), lang),
+            '--num_workers', args.num_dedup_procs,
+            '--watch',
+            *codec_args(args),
+        ), [dedup_dir]))
+        filter_dir = os.path.join(args.work_dir, f'{lang}_filter_text')
+        stages.append((f'filter_{lang}', script_cmd(
+            'apply_massivetext_filter.py',
+            '--data_dir', dedup_dir,
+            '--output_dir', filter_dir,
+            '--num_workers', args.num_filter_procs,
+            '--watch',
+            *codec_args(args),
+        ), [filter_dir]))
+        if args.near_dedup:
+            # 近似去重要看到所有文档, 放在最后: 边过滤边算 MinHash, 过滤结束后再去重
+            near_dedup_dir = os.path.join(args.work_dir, f'{lang}_near_dedup_text')
+            stages.append((f'near_dedup_{lang}', script_cmd(
+                'dedup_minhash.py',
+                '--data_dir', filter_dir,
+                '--output_dir', near_dedup_dir,
+                '--num_workers', args.num_dedup_procs,
+                '--watch',
+                *codec_args(args),
+            ), [near_dedup_dir]))
+    return stages
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run download, extract, dedup and filter concurrently, each stage picks up the finished shards of the previous one.")
+    parser.add_argument("--paths", required=True, help="The WARC paths file, see download_common_crawl_paths.py.")
+    parser.add_argument("--work_dir", required=True, help="Every stage writes its output to a sub-directory of it.")
+    parser.add_argument("--cc_domain", default="https://data.commoncrawl.org")
+    parser.add_argument("--langs", nargs='+', default=['zh', 'en'], choices=['zh', 'en'])
+    parser.add_argument("--extractor", default="goose", help="Main-content extractor of the extract stage: goose, lxml or trafilatura.")
+    parser.add_argument("--num_fetch_procs", default=6, type=int)
+    parser.add_argument("--num_write_procs", default=2, type=int)
+    parser.add_argument("--num_extract_procs", default=40, type=int)
+    parser.add_argument("--num_dedup_procs", default=8, type=int)
+    parser.add_argument("--num_filter_procs", default=30, type=int)
+    parser.add_argument("--extract_shard_size", default=10000, type=int, help="Records per extract output file; a file is filtered as soon as it is complete.")
+    parser.add_argument("--dedup_index_dir", default=None, help="Content hash indexes of the dedup stage, one per language, default <work_dir>/dedup_index. Share it between runs to drop pages kept by earlier snapshots.")
+    parser.add_argument("--near_dedup", action="store_true", help="Also drop near-duplicate records of the filter output with dedup_minhash.py.")
+    parser.add_argument("--codec", default="gzip")
+    parser.add_argument("--compress_level", default=None, type=int)
+    args = parser.parse_args()
+
+    os.makedirs(args.work_dir, exist_ok=True)
+    stages = build_stages(args)
+    # 在同一个 work_dir 里重新运行: 先去掉上次的结束标记, 不然下游阶段可能在上游删掉它之前就退出
+    for name, cmd, output_dirs in stages:
+        for output_dir in output_dirs:
+            if os.path.isdir(output_dir):
+                clear_done(output_dir)
+    procs = {}
+    for name, cmd, output_dirs in stages:
+        print(f'starting {name}:', ' '.join(cmd))
+        # 只 terminate 父进程的话, multiprocessing 的 worker 会留下来继续运行
+        procs[name] = Popen(cmd, start_new_session=True)
+    # 各阶段不在终端的进程组里, 收不到 Ctrl-C, 由这里转发
+    exit_on_sigterm()
+
+    # 某个阶段失败时结束其它阶段, 下游阶段会一直等待上游的结束标记
+    status = 0
+    try:
+        while procs:
+            for name, p in list(procs.items()):
+                ret = p.poll()
+                if ret is None:
+                    continue
+                del procs[name]
+                print(f'{name} finished with code {ret}')
+                if ret != 0 and status == 0:
+                    status = ret
+                    # 失败阶段留下的 worker 也一起结束
+                    stop_stage(p)
+                    for other in procs.values():
+                        stop_stage(other)
+            time.sleep(5)
+    finally:
+        for p in procs.values():
+            stop_stage(p)
+    sys.exit(status)
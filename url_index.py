@@ -0,0 +1,104 @@
+import hashlib
+import os
+from array import array
+from bisect import bisect_left
+from urllib.parse import urlsplit, urlunsplit
+
+import numpy as np
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+def normalize_url(url):
+    "lower-case scheme and host, no default port and no fragment, so the same page hashes the same"
+    try:
+        parts = urlsplit(url.strip())
+        scheme = parts.scheme.lower()
+        host = (parts.hostname or '').rstrip('.')
+        port = parts.port
+    except ValueError:
+        return url.strip()
+    netloc = host if port is None or DEFAULT_PORTS.get(scheme) == port else f'{host}:{port}'
+    return urlunsplit((scheme, netloc, parts.path or '/', parts.query, ''))
+
+def url_hash(url):
+    "the 8-byte blake2b of the normalized url"
+    return int.from_bytes(hashlib.blake2b(normalize_url(url).encode('utf-8'), digest_size=8).digest(), 'little')
+
+def url_domain(url):
+    try:
+        return (urlsplit(url.strip()).hostname or '').rstrip('.')
+    except ValueError:
+        return ''
+
+def load_domains(path):
+    "one domain per line, # starts a comment"
+    domains = set()
+    with open(path, 'r', encoding='utf-8') as fp:
+        for line in fp:
+            line = line.split('#')[0].strip().lower()
+            if line:
+                domains.add(line.lstrip('.'))
+    return frozenset(domains)
+
+def match_domain(domain, domains):
+    "domain or one of its parent domains is in domains"
+    parts = domain.split('.')
+    for i in range(len(parts)):
+        if '.'.join(parts[i:]) in domains:
+            return True
+    return False
+
+class UrlIndex:
+    """the hashes of the urls already kept, as a sorted array('Q') loaded once at startup
+    from the *.u64 files of index_dir (8 bytes per url); the downloader appends the urls it
+    keeps once they are in finished shards, they are seen by the next run"""
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        os.makedirs(index_dir, exist_ok=True)
+        parts = []
+        for fn in sorted(os.listdir(index_dir)):
+            if fn.endswith('.u64'):
+                with open(os.path.join(index_dir, fn), 'rb') as fp:
+                    data = fp.read()
+                # 中断时可能留下不完整的最后一个值
+                parts.append(np.frombuffer(data[:len(data) - len(data) % 8], dtype='<u8'))
+        hashes = np.unique(np.concatenate(parts)) if parts else np.empty(0, dtype='<u8')
+        self.hashes = array('Q', hashes.tobytes())
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def __contains__(self, h):
+        i = bisect_left(self.hashes, h)
+        return i < len(self.hashes) and self.hashes[i] == h
+
+    def append(self, name, hashes):
+        "append the hashes kept by one process to <index_dir>/<name>.u64"
+        if not hashes:
+            return
+        with open(os.path.join(self.index_dir, name + '.u64'), 'ab') as fp:
+            size = fp.seek(0, os.SEEK_END)
+            if size % 8:
+                fp.truncate(size - size % 8)
+            fp.write(array('Q', hashes).tobytes())
+
+class UrlFilter:
+    "decides from WARC-Target-URI alone whether the payload of a record is worth keeping"
+    def __init__(self, index=None, block_domains=frozenset(), allow_domains=None):
+        self.index = index
+        self.block_domains = block_domains
+        self.allow_domains = allow_domains
+
+    def __call__(self, url):
+        "True if the payload of the record of url should be kept"
+        if not url:
+            return True
+        if self.block_domains or self.allow_domains is not None:
+            domain = url_domain(url).lower()
+            if self.block_domains and match_domain(domain, self.block_domains):
+                return False
+            if self.allow_domains is not None and not match_domain(domain, self.allow_domains):
+                return False
+        if self.index is not None and url_hash(url) in self.index:
+            return False
+        return True
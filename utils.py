@@ -1,8 +1,295 @@
 import os
+import io
+import sys
+import signal
 import gzip
+import json
+import time
+import hashlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import inotify_simple
+except ImportError:
+    # 没有 inotify 时定时轮询
+    inotify_simple = None
+
+# 输出格式: codec -> 文件后缀
+CODECS = {
+    'gzip': '.jsonl.gz',
+    'zstd': '.jsonl.zst',
+    'none': '.jsonl',
+}
+DEFAULT_LEVELS = {'gzip': 9, 'zstd': 3, 'none': None}
+# 每个输出目录里记录已经写完的文件
+MANIFEST_NAME = 'manifest.jsonl'
+# 一个阶段写完整个输出目录之后创建的标记文件
+DONE_NAME = '_DONE'
+
+def add_codec_args(parser):
+    parser.add_argument("--codec", default="gzip", choices=sorted(CODECS), help="Compression of the output files. Input files are detected by their extension.")
+    parser.add_argument("--compress_level", default=None, type=int, help="Compression level of --codec, default 9 for gzip and 3 for zstd.")
+
+def detect_codec(path):
+    "the codec of a data file by its extension, None if it is not a data file"
+    for codec, ext in CODECS.items():
+        if path.endswith(ext):
+            return codec
+    if path.endswith('.zstd'):
+        return 'zstd'
+    return None
+
+def is_data_file(path):
+    return os.path.basename(path) != MANIFEST_NAME and detect_codec(path) is not None
+
+def strip_extension(path):
+    "raw_content_0.jsonl.gz -> raw_content_0"
+    codec = detect_codec(path)
+    if codec is not None and path.endswith(CODECS[codec]):
+        return path[:-len(CODECS[codec])]
+    return os.path.splitext(path)[0]
+
+def next_index(output_dir, prefix):
+    """the first file index after all existing <prefix>_<index> files, and those listed in the
+    manifest (they may have been moved away), safe when writers use a strike"""
+    indexes = [-1]
+    for fn in os.listdir(output_dir) + [entry['path'] for entry in read_manifest(output_dir)]:
+        name = strip_extension(fn)
+        if is_data_file(fn) and name.startswith(prefix + '_') and name[len(prefix) + 1:].isdigit():
+            indexes.append(int(name[len(prefix) + 1:]))
+    return max(indexes) + 1
+
+def _require_zstd():
+    if zstandard is None:
+        raise ImportError('zstd needs the zstandard package: pip install zstandard')
+
+def open_file(path, mode='rt', codec=None, level=None):
+    "open a (compressed) jsonl file, the codec is detected from the extension unless given"
+    if codec is None:
+        codec = detect_codec(path) or 'none'
+    if level is None:
+        level = DEFAULT_LEVELS[codec]
+    binary = 'b' in mode
+    raw_mode = mode.replace('t', '').replace('b', '') + 'b'
+    if codec == 'gzip':
+        fp = gzip.open(path, raw_mode, compresslevel=level)
+    elif codec == 'zstd':
+        _require_zstd()
+        fh = open(path, raw_mode)
+        if raw_mode == 'rb':
+            # 追加写入的文件由多个 zstd frame 组成
+            fp = zstandard.ZstdDecompressor().stream_reader(fh, read_across_frames=True)
+            fp = io.BufferedReader(fp)
+        else:
+            fp = zstandard.ZstdCompressor(level=level).stream_writer(fh)
+    elif codec == 'none':
+        fp = open(path, raw_mode)
+    else:
+        raise ValueError(f'unknown codec {codec}')
+    if binary:
+        return fp
+    return io.TextIOWrapper(fp, encoding='utf-8')
+
+def compress_block(data, codec='gzip', level=None):
+    "compress bytes into an independent gzip member / zstd frame that can be appended to a file"
+    if level is None:
+        level = DEFAULT_LEVELS[codec]
+    if codec == 'gzip':
+        return gzip.compress(data, compresslevel=level)
+    if codec == 'zstd':
+        _require_zstd()
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    if codec == 'none':
+        return data
+    raise ValueError(f'unknown codec {codec}')
+
+def append_manifest(output_dir, entry):
+    "append one finished shard to the manifest of output_dir, safe with several writer processes"
+    line = (json.dumps(entry, ensure_ascii=False) + '\n').encode('utf-8')
+    fd = os.open(os.path.join(output_dir, MANIFEST_NAME), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        # 一次 write 追加一整行, 多个进程同时追加也不会交错
+        os.write(fd, line)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def read_manifest(output_dir):
+    "the manifest entries of the finished shards in output_dir, [] if there is no manifest"
+    manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+    if not os.path.exists(manifest_path):
+        return []
+    entries = []
+    with open(manifest_path, 'r', encoding='utf-8') as fp:
+        for line in fp:
+            if line.strip():
+                entries.append(json.loads(line))
+    return entries
+
+def mark_done(output_dir):
+    "tell the stages watching output_dir that no more shards will be added"
+    with open(os.path.join(output_dir, DONE_NAME), 'w', encoding='utf-8') as fp:
+        fp.write(f'{time.time()}\n')
+
+def clear_done(output_dir):
+    "a stage restarted on output_dir removes its marker first, or the stages watching it would stop early"
+    path = os.path.join(output_dir, DONE_NAME)
+    if os.path.exists(path):
+        os.remove(path)
+
+def is_done(output_dir):
+    return os.path.exists(os.path.join(output_dir, DONE_NAME))
+
+def exit_on_sigterm():
+    """turn SIGTERM (run_pipeline.py stopping a stage) into SystemExit, so the finally blocks
+    commit the open shards; installed before the workers are started, they inherit it"""
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+
+def _wait_for_change(data_dir, timeout):
+    if inotify_simple is None or not os.path.isdir(data_dir):
+        time.sleep(timeout)
+        return
+    flags = inotify_simple.flags
+    with inotify_simple.INotify() as inotify:
+        inotify.add_watch(data_dir, flags.MODIFY | flags.CREATE | flags.MOVED_TO)
+        inotify.read(timeout=int(timeout * 1000))
+
+def watch_shards(data_dir, poll_interval=10):
+    """yield the paths of the finished shards of data_dir as they are added to its manifest,
+    until the stage writing data_dir has marked it done"""
+    seen = set()
+    while 1:
+        # 先检查结束标记再读 manifest, 保证结束前写入的文件都能读到
+        done = is_done(data_dir)
+        for entry in read_manifest(data_dir):
+            fn = entry['path']
+            if fn in seen:
+                continue
+            seen.add(fn)
+            if os.path.exists(os.path.join(data_dir, fn)):
+                yield os.path.join(data_dir, fn)
+        if done:
+            break
+        _wait_for_change(data_dir, poll_interval)
+
+def iter_windows(lines, window_size):
+    window = []
+    for line in lines:
+        window.append(line)
+        if len(window) >= window_size:
+            yield window
+            window = []
+    if window:
+        yield window
+
+def map_windows(pool, func, lines, batch_size, chunksize):
+    """(line, func(line)) in input order, computed by the pool; the window after the one
+    being consumed is already submitted, so at most two windows of lines are in memory"""
+    # 直接把整个文件交给 imap 的话, 它会一次读完所有行
+    pending = None
+    for window in iter_windows(lines, batch_size):
+        results = pool.imap(func, window, chunksize)
+        if pending is not None:
+            yield from zip(*pending)
+        pending = window, results
+    if pending is not None:
+        yield from zip(*pending)
+
+class _HashingFile(io.RawIOBase):
+    "counts and hashes the bytes written to the underlying file"
+    def __init__(self, fp):
+        self._fp = fp
+        self.sha256 = hashlib.sha256()
+        self.num_bytes = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.sha256.update(data)
+        self.num_bytes += len(data)
+        return self._fp.write(data)
+
+    def flush(self):
+        self._fp.flush()
+
+class Shard:
+    """a data file written under a temporary name, renamed into place and added to the
+    manifest of its directory only once it is complete"""
+    def __init__(self, path, codec='gzip', level=None):
+        self.path = path
+        self.tmp_path = path + '.tmp'
+        self.num_items = 0
+        self._raw = open(self.tmp_path, 'wb')
+        self._hashing = _HashingFile(self._raw)
+        self.codec = codec
+        self.level = DEFAULT_LEVELS[codec] if level is None else level
+        self._compressed = None
+        self._text = None
+
+    def _stream(self):
+        "the stream compressing the lines, created on the first line"
+        if self._compressed is None:
+            # 只用 write_block 追加压缩好的数据时不创建压缩流
+            if self.codec == 'gzip':
+                self._compressed = gzip.GzipFile(fileobj=self._hashing, mode='wb', compresslevel=self.level)
+            elif self.codec == 'zstd':
+                _require_zstd()
+                self._compressed = zstandard.ZstdCompressor(level=self.level).stream_writer(self._hashing, closefd=False)
+            else:
+                self._compressed = io.BufferedWriter(self._hashing)
+        return self._compressed
+
+    def write_line(self, line):
+        "line is a str, or bytes that are written unchanged, e.g. a line read from another shard"
+        if isinstance(line, bytes):
+            if self._text is not None:
+                self._text.flush()
+            stream = self._stream()
+            stream.write(line)
+            if not line.endswith(b'\n'):
+                stream.write(b'\n')
+        else:
+            if self._text is None:
+                self._text = io.TextIOWrapper(self._stream(), encoding='utf-8')
+            self._text.write(line)
+            self._text.write('\n')
+        self.num_items += 1
+
+    def write_block(self, data, num_items):
+        "append an already compressed block, e.g. from compress_block"
+        self._hashing.write(data)
+        self.num_items += num_items
+
+    def close(self):
+        if self._text is not None:
+            self._text.flush()
+            self._text.detach()
+        if self._compressed is not None:
+            self._compressed.close()
+        self._raw.flush()
+        os.fsync(self._raw.fileno())
+        self._raw.close()
+        os.replace(self.tmp_path, self.path)
+        output_dir = os.path.dirname(self.path) or '.'
+        dir_fd = os.open(output_dir, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+        append_manifest(output_dir, {
+            'path': os.path.basename(self.path),
+            'records': self.num_items,
+            'bytes': self._hashing.num_bytes,
+            'sha256': self._hashing.sha256.hexdigest(),
+        })
 
 class Writer:
-    def __init__(self, output_dir, prefix='file', offset=0, strike=1, max_items=50000):
+    def __init__(self, output_dir, prefix='file', offset=0, strike=1, max_items=50000, codec='gzip', level=None):
         self.output_dir = output_dir
         self.prefix = prefix
         self.offset = offset
@@ -10,12 +297,14 @@ class Writer:
         self.strike = strike
         self.num_items = 0
         self.max_items = max_items
+        self.codec = codec
+        self.level = level
         self._fp = None
         
     def get_fp(self):
         if self._fp is None:
-            output_path = os.path.join(self.output_dir, f'{self.prefix}_{self.strike_idx * self.strike + self.offset}.jsonl.gz')
-            self._fp = gzip.open(output_path, 'wt', encoding='utf-8')
+            output_path = os.path.join(self.output_dir, f'{self.prefix}_{self.strike_idx * self.strike + self.offset}{CODECS[self.codec]}')
+            self._fp = Shard(output_path, self.codec, self.level)
         return self._fp
     
     def update_fp(self):
@@ -23,16 +312,28 @@ class Writer:
         if self._fp is not None:
             self._fp.close()
             self.strike_idx += 1
+        # 下一个文件在写入第一条数据时才创建
         self._fp = None
-        return self.get_fp()
         
     def write_line(self, line):
         fp = self.get_fp()
-        fp.write(line)
-        fp.write('\n')
+        fp.write_line(line)
         self.num_items += 1
-        if self.num_items % self.max_items == 0:
+        if fp.num_items >= self.max_items:
             self.update_fp()
+
+    def write_block(self, data, num_items):
+        "append a block from compress_block, files roll over at the first block boundary after max_items"
+        fp = self.get_fp()
+        fp.write_block(data, num_items)
+        self.num_items += num_items
+        if fp.num_items >= self.max_items:
+            self.update_fp()
+
+    def close(self):
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
             
 if __name__ == '__main__':
     writer = Writer('test', offset=1, max_items=1000000)